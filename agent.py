@@ -1,12 +1,18 @@
 # Agent Logic
+import asyncio
 from typing import Optional
 
 from state import AgentState
-from llm import agent_step
+from llm import aagent_step, run_sync
 from tools import execute_tool, get_allowed_tool_names
 
 
 def run_agent_tick(state: AgentState) -> tuple[str, bool]:
+    """Synchronous wrapper around arun_agent_tick() for callers without an event loop."""
+    return run_sync(arun_agent_tick(state))
+
+
+async def arun_agent_tick(state: AgentState) -> tuple[str, bool]:
     """
     Execute one agent step.
     
@@ -19,17 +25,12 @@ def run_agent_tick(state: AgentState) -> tuple[str, bool]:
     # Consume pending notes
     notes = state.consume_notes()
     
-    # Get previous tool result if any
-    tool_result = None
-    if state.history and state.history[-1].get("role") == "tool_result":
-        tool_result = state.history[-1].get("content")
-    
     # Get agent decision
-    decision = agent_step(
+    decision = await aagent_step(
         goal=state.goal,
-        history=[h for h in state.history if h.get("role") != "tool_result"],
+        history=state.history_for_prompt,
         pending_notes=notes,
-        tool_result=tool_result
+        tool_result=state.last_tool_result
     )
     
     # Handle error
@@ -41,10 +42,7 @@ def run_agent_tick(state: AgentState) -> tuple[str, bool]:
         return f"❌ Agent error: {error_msg}", False
     
     # Record decision in history
-    state.history.append({
-        "role": "assistant",
-        "content": str(decision)
-    })
+    state.record_decision(str(decision))
     
     action = decision.get("action", "")
     message = decision.get("message", "")
@@ -93,13 +91,10 @@ def run_agent_tick(state: AgentState) -> tuple[str, bool]:
         return f"❌ Tool not allowed: {tool_name}", False
     
     # Execute tool
-    result = execute_tool(tool_name, args, allowed_tool_names=allowed_tools)
+    result = await asyncio.to_thread(execute_tool, tool_name, args, allowed_tool_names=allowed_tools)
     
     # Record result
-    state.history.append({
-        "role": "tool_result",
-        "content": result
-    })
+    state.record_tool_result(result)
     
     state.increment_step()
     state.save()
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
 
+from keywords import compile_keywords
+
 
 @dataclass
 class InferenceBudget:
@@ -39,8 +41,10 @@ DEEP_INTENT_WORDS = [
 ]
 
 
+DEEP_INTENT_RE = compile_keywords(DEEP_INTENT_WORDS)
+
+
 def select_budget(user_input: str) -> InferenceBudget:
-    lower = user_input.lower()
-    if any(w.lower() in lower for w in DEEP_INTENT_WORDS):
+    if DEEP_INTENT_RE.search(user_input.lower()):
         return DEEP_BUDGET
     return DEFAULT_BUDGET
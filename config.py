@@ -27,15 +27,36 @@ OLLAMA_MAIN_PREDICT = int(os.environ.get("OLLAMA_MAIN_PREDICT", "512"))
 OLLAMA_HEAVY_PREDICT = int(os.environ.get("OLLAMA_HEAVY_PREDICT", "768"))
 
 OLLAMA_ROUTER_KEEP_ALIVE = os.environ.get("OLLAMA_ROUTER_KEEP_ALIVE", "5m")
-OLLAMA_MAIN_KEEP_ALIVE = os.environ.get("OLLAMA_MAIN_KEEP_ALIVE", "10m")
+OLLAMA_MAIN_KEEP_ALIVE = os.environ.get("OLLAMA_MAIN_KEEP_ALIVE", "30m")
 OLLAMA_HEAVY_KEEP_ALIVE = os.environ.get("OLLAMA_HEAVY_KEEP_ALIVE", "0")
 
+# Ollama サーバー側の OLLAMA_NUM_PARALLEL と揃える。クライアント側の同時リクエスト数の上限に使う。
+OLLAMA_NUM_PARALLEL = max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", "1")))
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get("OLLAMA_MAX_CONNECTIONS", "16"))
+
+# 類似検索用の埋め込みモデル (例: bge-m3)。空なら埋め込みを使う機能は全て無効。
+OLLAMA_EMBED_MODEL = os.environ.get("OLLAMA_EMBED_MODEL", "")
+OLLAMA_EMBED_URL = os.environ.get("OLLAMA_EMBED_URL", OLLAMA_URL.rsplit("/api/", 1)[0] + "/api/embed")
+SEMANTIC_TOOL_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_TOOL_CACHE_THRESHOLD", "0.92"))
+MEMORY_SEARCH_MIN_SIMILARITY = float(os.environ.get("MEMORY_SEARCH_MIN_SIMILARITY", "0.6"))
+
+# LLM 応答キャッシュ。オフ推奨がデフォルト (同じ入力に同じ返答を返すようになるため)。
+ENABLE_LLM_CACHE = os.environ.get("ENABLE_LLM_CACHE", "0") == "1"
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "512"))
+
 ENABLE_ADAPTIVE_ROUTING = os.environ.get("ENABLE_ADAPTIVE_ROUTING", "1") == "1"
 ROUTER_CONFIDENCE_EARLY_EXIT = float(os.environ.get("ROUTER_CONFIDENCE_EARLY_EXIT", "0.85"))
 ROUTER_CONFIDENCE_VERIFY = float(os.environ.get("ROUTER_CONFIDENCE_VERIFY", "0.65"))
 ROUTER_CONFIDENCE_HEAVY = float(os.environ.get("ROUTER_CONFIDENCE_HEAVY", "0.45"))
 
 REACT_MAX_TURNS = int(os.environ.get("REACT_MAX_TURNS", "2"))
+TOOL_CONCURRENCY_LIMIT = max(1, int(os.environ.get("TOOL_CONCURRENCY_LIMIT", "1")))
+
+# MafuyuSession がプロンプトに載せる直近履歴の見積もりトークン数。はみ出した分は要約に回す。
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "1536"))
+CHAT_HISTORY_MAX_MESSAGES = int(os.environ.get("CHAT_HISTORY_MAX_MESSAGES", "12"))
+AGENT_HISTORY_MAX_MESSAGES = int(os.environ.get("AGENT_HISTORY_MAX_MESSAGES", "12"))
 
 ENABLE_BEST_OF_N = os.environ.get("ENABLE_BEST_OF_N", "0") == "1"
 BEST_OF_N_MAX = int(os.environ.get("BEST_OF_N_MAX", "3"))
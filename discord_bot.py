@@ -1,6 +1,9 @@
 import asyncio
 import os
+import re
+import subprocess
 import sys
+import time
 from datetime import datetime, timedelta
 
 import discord
@@ -8,10 +11,12 @@ from discord.ext import commands, tasks
 
 from config import (
     ALLOWED_ROLE_IDS,
+    BASE_DIR,
     DISCORD_ALLOWED_USER_ID,
     ENABLE_CODEX_BRIDGE_AUTOSTART,
     FREE_CHAT_CHANNELS,
 )
+from llm import aclose_async_client
 from mafuyu import MafuyuSession
 
 
@@ -22,12 +27,26 @@ if sys.platform == "win32":
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class MafuyuBot(commands.Bot):
+    async def close(self):
+        await super().close()
+        # Ollama への接続プールも bot の loop が閉じる前に閉じる
+        await aclose_async_client()
+
+
+bot = MafuyuBot(command_prefix="!", intents=intents)
+
+# ストリーミング返信の編集間隔 (Discord の rate limit を避けるため、秒数か文字数のどちらかで間引く)
+STREAM_EDIT_INTERVAL = 0.8
+STREAM_EDIT_CHARS = 40
 
 sessions: dict[int, MafuyuSession] = {}
-last_channel_id = None
-last_user_name = None
-last_message_time = None
+# 自律発話の対象 DM チャンネル: channel_id -> {"user_name": str, "last_message_time": datetime}
+auto_talk_targets: dict[int, dict] = {}
+# on_ready は再接続のたびに呼ばれるので、起動済みの bridge プロセスを覚えておく
+bridge_process: subprocess.Popen | None = None
+# <@id> / <@!id> をまとめて消すパターン。bot.user が確定する on_ready で作る。
+_MENTION_RE: re.Pattern | None = None
 
 
 def is_allowed_user(author) -> bool:
@@ -72,11 +91,68 @@ def get_session(guild_id: int = None, user_id: int = None) -> MafuyuSession:
 
 
 def strip_bot_mention(content: str) -> str:
-    if not bot.user:
-        return content.strip()
-    mention = f"<@{bot.user.id}>"
-    mention_nick = f"<@!{bot.user.id}>"
-    return content.replace(mention, "").replace(mention_nick, "").strip()
+    return (_MENTION_RE.sub("", content) if _MENTION_RE else content).strip()
+
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+class StreamingReply:
+    """生成途中の本文で返信を送り、その後は同じメッセージを編集して追記していく。"""
+
+    def __init__(self, message_obj: discord.Message):
+        self.message_obj = message_obj
+        self.sent: discord.Message | None = None
+        self.shown = ""
+        self.last_edit = 0.0
+        self._pending: asyncio.Task | None = None
+        # 一度送信/編集に失敗したら途中経過は出さず、finish() の最終返信だけにする
+        self._failed = False
+
+    def update(self, text: str) -> None:
+        text = text[:DISCORD_MESSAGE_LIMIT]
+        if self._failed or (self._pending and not self._pending.done()):
+            return
+        if self.sent is not None and (
+            time.monotonic() - self.last_edit < STREAM_EDIT_INTERVAL
+            and len(text) - len(self.shown) < STREAM_EDIT_CHARS
+        ):
+            return
+        self.shown = text
+        self.last_edit = time.monotonic()
+        self._pending = asyncio.create_task(self._push(text))
+        self._pending.add_done_callback(self._on_push_done)
+
+    def _on_push_done(self, task: asyncio.Task) -> None:
+        # 例外はここで取り出す (次の update で _pending を上書きしても握りつぶさない)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self._failed = True
+            print(f"[Stream] edit failed: {exc}")
+
+    async def _push(self, text: str) -> None:
+        if self.sent is None:
+            self.sent = await self.message_obj.reply(text, allowed_mentions=discord.AllowedMentions.none())
+        else:
+            await self.sent.edit(content=text)
+
+    async def finish(self, text: str) -> None:
+        if self._pending:
+            # 失敗は _on_push_done が記録済み
+            await asyncio.wait({self._pending})
+        head, rest = text[:DISCORD_MESSAGE_LIMIT], text[DISCORD_MESSAGE_LIMIT:]
+        if self.sent is None or self._failed:
+            # 編集に失敗したメッセージには触らず、最終返信を新しく送る
+            await self.message_obj.reply(head, allowed_mentions=discord.AllowedMentions.none())
+        elif head != self.shown:
+            await self.sent.edit(content=head)
+        # 上限を超えた分は続きのメッセージで送る
+        for i in range(0, len(rest), DISCORD_MESSAGE_LIMIT):
+            await self.message_obj.channel.send(
+                rest[i:i + DISCORD_MESSAGE_LIMIT], allowed_mentions=discord.AllowedMentions.none()
+            )
 
 
 async def run_session_response(
@@ -90,40 +166,65 @@ async def run_session_response(
     is_owner: bool,
     has_allowed_role: bool,
 ) -> str:
-    loop = asyncio.get_running_loop()
-
     def progress_callback(status: str):
         print(f"[Callback] {status}")
 
-    return await loop.run_in_executor(
-        None,
-        lambda: session.respond(
-            content,
-            user_name,
-            progress_callback,
-            allow_tools,
-            is_dm=is_dm,
-            is_owner=is_owner,
-            has_allowed_role=has_allowed_role,
-        ),
+    stream = StreamingReply(message_obj)
+    response = await session.arespond(
+        content,
+        user_name,
+        progress_callback,
+        allow_tools,
+        is_dm=is_dm,
+        is_owner=is_owner,
+        has_allowed_role=has_allowed_role,
+        on_partial=stream.update,
     )
+    await stream.finish(response)
+    return response
+
+
+def start_codex_bridge() -> None:
+    global bridge_process
+
+    if bridge_process is not None and bridge_process.poll() is None:
+        return
+
+    bridge_script = BASE_DIR / "codex_bridge.py"
+    if not bridge_script.exists():
+        print(f"[AutoLaunch] {bridge_script.name} not found, skipping bridge autostart.")
+        return
+
+    # shell を挟まず同じインタプリタで直接起動する。Windows では従来どおり別コンソールを開く。
+    creationflags = subprocess.CREATE_NEW_CONSOLE if sys.platform == "win32" else 0
+    try:
+        print(f"[AutoLaunch] Starting {bridge_script.name} in new window...")
+        bridge_process = subprocess.Popen(
+            [sys.executable, str(bridge_script)],
+            cwd=BASE_DIR,
+            creationflags=creationflags,
+        )
+    except OSError as e:
+        print(f"[AutoLaunch] Failed to start bridge: {e}")
+
+
+def stop_codex_bridge() -> None:
+    if bridge_process is not None and bridge_process.poll() is None:
+        bridge_process.terminate()
 
 
 @bot.event
 async def on_ready():
+    global _MENTION_RE
+    _MENTION_RE = re.compile(rf"<@!?{bot.user.id}>")
+
     print("=== Mafuyu Bot Online ===")
     print(f"Logged in as: {bot.user}")
     if DISCORD_ALLOWED_USER_ID <= 0:
         print("[Config] DISCORD_ALLOWED_USER_ID is not set. DM access is disabled.")
 
     if ENABLE_CODEX_BRIDGE_AUTOSTART:
-        bridge_script = "codex_bridge.py"
-        try:
-            import subprocess
-            print(f"[AutoLaunch] Starting {bridge_script} in new window...")
-            subprocess.Popen(f'start "Codex Bridge (Mafuyu)" python {bridge_script}', shell=True)
-        except Exception as e:
-            print(f"[AutoLaunch] Failed to start bridge: {e}")
+        start_codex_bridge()
 
     if not auto_talk_loop.is_running():
         auto_talk_loop.start()
@@ -137,35 +238,52 @@ async def on_command_error(ctx, error):
     raise error
 
 
-@tasks.loop(minutes=20.0)
-async def auto_talk_loop():
-    global last_channel_id, last_message_time
-    if not last_channel_id or not last_message_time:
-        return
-    if datetime.now() - last_message_time < timedelta(minutes=60):
-        return
-    if 0 <= datetime.now().hour < 7:
-        return
+def touch_auto_talk_target(channel_id: int) -> None:
+    target = auto_talk_targets.get(channel_id)
+    if target:
+        target["last_message_time"] = datetime.now()
+
 
-    channel = bot.get_channel(last_channel_id)
+async def auto_talk_once(channel_id: int, target: dict) -> None:
+    channel = bot.get_channel(channel_id)
     if not channel:
         return
 
-    session = get_session(user_id=last_channel_id)
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(None, session.initiate_talk, last_user_name)
+    session = get_session(user_id=channel_id)
+    response = await session.ainitiate_talk(target["user_name"])
 
     if response:
         async with channel.typing():
             await asyncio.sleep(3)
-            last_message_time = datetime.now()
+            target["last_message_time"] = datetime.now()
             await channel.send(response)
 
 
+@tasks.loop(minutes=20.0)
+async def auto_talk_loop():
+    now = datetime.now()
+    if 0 <= now.hour < 7:
+        return
+
+    eligible = [
+        (channel_id, target)
+        for channel_id, target in auto_talk_targets.items()
+        if now - target["last_message_time"] >= timedelta(minutes=60)
+    ]
+    if not eligible:
+        return
+
+    results = await asyncio.gather(
+        *(auto_talk_once(channel_id, target) for channel_id, target in eligible),
+        return_exceptions=True,
+    )
+    for (channel_id, _), result in zip(eligible, results):
+        if isinstance(result, Exception):
+            print(f"[AutoTalk] channel {channel_id} failed: {result}")
+
+
 @bot.event
 async def on_message(message):
-    global last_channel_id, last_user_name, last_message_time
-
     if message.author.bot:
         return
 
@@ -176,9 +294,10 @@ async def on_message(message):
         return
 
     if is_dm and is_allowed_user(message.author):
-        last_channel_id = message.channel.id
-        last_user_name = message.author.global_name or message.author.name
-        last_message_time = datetime.now()
+        auto_talk_targets[message.channel.id] = {
+            "user_name": message.author.global_name or message.author.name,
+            "last_message_time": datetime.now(),
+        }
 
     is_mention = bot.user and bot.user.id in [m.id for m in message.mentions]
     is_free_chat = message.channel.id in FREE_CHAT_CHANNELS
@@ -213,7 +332,7 @@ async def on_message(message):
         )
         user_name = message.author.global_name or message.author.name
         allow_tools = is_dm or has_allowed_role
-        response = await run_session_response(
+        await run_session_response(
             session,
             content,
             user_name,
@@ -223,9 +342,7 @@ async def on_message(message):
             is_owner=is_allowed_user(message.author),
             has_allowed_role=has_allowed_role,
         )
-        last_message_time = datetime.now()
-
-    await message.reply(response, allowed_mentions=discord.AllowedMentions.none())
+        touch_auto_talk_target(message.channel.id)
 
 
 @bot.command(name="clear")
@@ -251,7 +368,7 @@ async def talk_to_mafuyu(ctx, *, message: str = None):
         )
         user_name = ctx.author.global_name or ctx.author.name
         allow_tools = command_tools_allowed(ctx)
-        response = await run_session_response(
+        await run_session_response(
             session,
             message,
             user_name,
@@ -262,8 +379,6 @@ async def talk_to_mafuyu(ctx, *, message: str = None):
             has_allowed_role=False if ctx.guild is None else user_has_allowed_role(ctx.author),
         )
 
-    await ctx.reply(response, allowed_mentions=discord.AllowedMentions.none())
-
 
 if __name__ == "__main__":
     token = os.environ.get("DISCORD_TOKEN")
@@ -283,4 +398,7 @@ if __name__ == "__main__":
         print("Set DISCORD_TOKEN in the environment or discord.env.")
         print("=" * 50)
     else:
-        bot.run(token)
+        try:
+            bot.run(token)
+        finally:
+            stop_codex_bridge()
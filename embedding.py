@@ -0,0 +1,80 @@
+# Embeddings (Ollama /api/embed)
+#
+# OLLAMA_EMBED_MODEL が空 (デフォルト) のときは無効で、embed() は None を返す。
+# 呼び出し側は None なら従来の完全一致/部分一致の経路だけを使う。
+import math
+import operator
+import time
+
+import requests
+
+from config import OLLAMA_EMBED_MODEL, OLLAMA_EMBED_URL
+import jsonutil
+
+
+_SESSION = requests.Session()
+_SESSION.headers.update({"Content-Type": "application/json"})
+
+
+def _normalize(vector: list[float]) -> list[float]:
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else vector
+
+
+def embed(texts: list[str]) -> list[list[float]] | None:
+    """Return one L2-normalized vector per text, or None if embeddings are disabled/unavailable."""
+    if not OLLAMA_EMBED_MODEL or not texts:
+        return None
+    try:
+        resp = _SESSION.post(
+            OLLAMA_EMBED_URL,
+            data=jsonutil.dumps({"model": OLLAMA_EMBED_MODEL, "input": texts}),
+            timeout=30,
+        )
+        resp.raise_for_status()
+        vectors = jsonutil.loads(resp.content).get("embeddings") or []
+    except (requests.RequestException, ValueError) as e:
+        print(f"[Embed] skipped: {e}")
+        return None
+    if len(vectors) != len(texts):
+        return None
+    return [_normalize(v) for v in vectors]
+
+
+def cosine(a: list[float], b: list[float]) -> float:
+    """Cosine similarity of two normalized vectors."""
+    return sum(map(operator.mul, a, b))
+
+
+class SemanticCache:
+    """Nearest-neighbour lookup over a small number of (vector, value) pairs, optionally expiring after ttl seconds."""
+
+    def __init__(self, threshold: float, max_entries: int = 256, ttl: float | None = None):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (登録時刻, vector, value) の組で持つ。append/pop が1回ずつで済み、ツール実行スレッドから触っても組がずれない。
+        self._entries: list[tuple[float, list[float], object]] = []
+
+    def _expire(self) -> None:
+        if self.ttl is None:
+            return
+        # 追加順 = 登録時刻順なので、先頭から期限切れを落とせば済む
+        cutoff = time.time() - self.ttl
+        while self._entries and self._entries[0][0] <= cutoff:
+            self._entries.pop(0)
+
+    def get(self, vector: list[float], threshold: float | None = None):
+        self._expire()
+        best, best_sim = None, self.threshold if threshold is None else threshold
+        for _, cached, value in list(self._entries):
+            sim = cosine(cached, vector)
+            if sim >= best_sim:
+                best, best_sim = value, sim
+        return best
+
+    def put(self, vector: list[float], value) -> None:
+        self._expire()
+        if len(self._entries) >= self.max_entries:
+            self._entries.pop(0)
+        self._entries.append((time.time(), vector, value))
@@ -1,84 +1,151 @@
-import json
+import atexit
+import os
+import threading
+import time
+from bisect import bisect_right
 from pathlib import Path
 from datetime import datetime
 from config import BASE_DIR
+import jsonutil
 
 EMOTION_FILE = BASE_DIR / "data" / "emotion.json"
+EMOTION_SAVE_INTERVAL = 5.0  # seconds between disk writes during a chat burst
+
+# Description buckets: DESC[i] applies when THRESHOLDS[i-1] <= value < THRESHOLDS[i].
+AFFECTION_THRESHOLDS = (40, 70, 90)
+AFFECTION_DESC = ("Low (Stranger/Cold)", "Neutral (Friend)", "High Trust (Close)", "Love (Devoted)")
+
+MOOD_THRESHOLDS = (-30, -10, 10, 30)
+MOOD_DESC = (
+    "Terrible (Angry/Cold)",
+    "Bad (Annoyed/Sarcastic)",
+    "Neutral (Calm)",
+    "Good (Positive)",
+    "Excellent (Happy/Playful)",
+)
+
+ENERGY_THRESHOLDS = (30, 80)
+ENERGY_DESC = ("Low (Sleepy/Tired)", "Normal", "High (Energetic)")
+
+EMOTION_PROMPT_TEMPLATE = """[Emotional State]
+- Affection: {aff} ({aff_desc})
+- Mood: {mood} ({mood_desc})
+- Energy: {energy} ({ene_desc})
+(Instruction: Adjust your tone based on these. Low Mood = Cold/Sarcastic. High Affection = Sweet/Deredere. Low Energy = Short/Lazy.)"""
+
+def decay(mood: int, energy: int, elapsed_hours: float) -> tuple[int, int]:
+    """Time-based recovery: energy +10/hour (max 100), mood moves towards 0 by 5/hour."""
+    energy = min(100, energy + int(elapsed_hours * 10))
+    step = int(elapsed_hours * 5)
+    if mood > 0:
+        mood = max(0, mood - step)
+    elif mood < 0:
+        mood = min(0, mood + step)
+    return mood, energy
 
 class EmotionSystem:
     def __init__(self):
         self.states = {}
+        self._dirty = False
+        self._last_save = 0.0
+        # 感情更新はイベントループ、遅延保存はタイマースレッドから来るので states はこの lock の下で触る
+        self._lock = threading.RLock()
+        self._flush_timer: threading.Timer | None = None
         self.load()
     
     def load(self):
         if EMOTION_FILE.exists():
             try:
-                self.states = json.loads(EMOTION_FILE.read_text(encoding="utf-8"))
+                self.states = jsonutil.loads(EMOTION_FILE.read_bytes())
             except:
                 self.states = {}
+
+        # One-shot migration: older files stored "last_update" as an ISO string.
+        for state in self.states.values():
+            last_str = state.pop("last_update", None)
+            if "last_update_ts" not in state:
+                try:
+                    state["last_update_ts"] = datetime.fromisoformat(last_str).timestamp()
+                except (TypeError, ValueError):
+                    state["last_update_ts"] = time.time()
     
     def save(self):
-        EMOTION_FILE.parent.mkdir(exist_ok=True)
-        EMOTION_FILE.write_text(json.dumps(self.states, ensure_ascii=False, indent=2), encoding="utf-8")
+        with self._lock:
+            EMOTION_FILE.parent.mkdir(exist_ok=True)
+            tmp_path = EMOTION_FILE.with_suffix(".json.tmp")
+            tmp_path.write_bytes(jsonutil.dumps(self.states))
+            os.replace(tmp_path, EMOTION_FILE)  # no torn file if we crash mid-write
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def flush(self):
+        """Write pending updates, if any."""
+        with self._lock:
+            self._flush_timer = None
+            if self._dirty:
+                self.save()
+
+    def _schedule_flush(self):
+        # 間引いた更新も EMOTION_SAVE_INTERVAL 以内には必ず書く (次の更新や終了を待たない)
+        if self._flush_timer is None:
+            delay = max(0.0, EMOTION_SAVE_INTERVAL - (time.monotonic() - self._last_save))
+            self._flush_timer = threading.Timer(delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
         
     def get_state(self, user_id: str) -> dict:
         """Get state for a user, initializing if new."""
         # Convert ID to string key
         key = str(user_id)
         
-        # Default State
-        if key not in self.states:
-            self.states[key] = {
-                "affection": 50,  # 0-100 (50 = Classmate/Friend, NOT Stranger)
-                "mood": 0,        # -50 to +50 (Temporary mood)
-                "energy": 80,     # 0-100 (Stamina)
-                "last_update": datetime.now().isoformat()
-            }
-        
-        # Apply time-based decay/recovery (Energy recovers, Mood neutralizes)
-        self._apply_time_effects(key)
-        
-        return self.states[key]
+        with self._lock:
+            # Default State
+            if key not in self.states:
+                self.states[key] = {
+                    "affection": 50,  # 0-100 (50 = Classmate/Friend, NOT Stranger)
+                    "mood": 0,        # -50 to +50 (Temporary mood)
+                    "energy": 80,     # 0-100 (Stamina)
+                    "last_update_ts": time.time()  # epoch seconds
+                }
+
+            # Apply time-based decay/recovery (Energy recovers, Mood neutralizes)
+            self._apply_time_effects(key)
+
+            return self.states[key]
     
     def update_state(self, user_id: str, affection_delta=0, mood_delta=0, energy_delta=0):
         key = str(user_id)
-        state = self.get_state(key) # This also applies time effects first
-        
-        # Update values with clamping
-        state["affection"] = max(0, min(100, state["affection"] + affection_delta))
-        state["mood"] = max(-50, min(50, state["mood"] + mood_delta))
-        state["energy"] = max(0, min(100, state["energy"] + energy_delta))
-        
-        state["last_update"] = datetime.now().isoformat()
-        self.save()
-        
-        return state
+        with self._lock:
+            state = self.get_state(key) # This also applies time effects first
+
+            # Update values with clamping
+            state["affection"] = max(0, min(100, state["affection"] + affection_delta))
+            state["mood"] = max(-50, min(50, state["mood"] + mood_delta))
+            state["energy"] = max(0, min(100, state["energy"] + energy_delta))
+
+            state["last_update_ts"] = time.time()
+            self._dirty = True
+            if time.monotonic() - self._last_save > EMOTION_SAVE_INTERVAL:
+                self.save()
+            else:
+                self._schedule_flush()
+
+            return state
 
     def _apply_time_effects(self, key: str):
         state = self.states[key]
-        last_str = state.get("last_update")
-        if not last_str:
+        last_ts = state.get("last_update_ts")
+        if last_ts is None:
             return
             
-        last_time = datetime.fromisoformat(last_str)
-        now = datetime.now()
-        elapsed_hours = (now - last_time).total_seconds() / 3600
+        now = time.time()
+        elapsed_hours = (now - last_ts) / 3600
         
         if elapsed_hours < 1:
             return
             
-        # Recovery Logic
-        # Energy recovers: +10 per hour
-        energy_rec = int(elapsed_hours * 10)
-        state["energy"] = min(100, state["energy"] + energy_rec)
-        
-        # Mood neutralizes: moves towards 0 by 5 per hour
-        if state["mood"] > 0:
-            state["mood"] = max(0, state["mood"] - int(elapsed_hours * 5))
-        elif state["mood"] < 0:
-            state["mood"] = min(0, state["mood"] + int(elapsed_hours * 5))
-            
-        state["last_update"] = now.isoformat()
+        state["mood"], state["energy"] = decay(state["mood"], state["energy"], elapsed_hours)
+        state["last_update_ts"] = now
 
     def get_prompt_text(self, user_id: str) -> str:
         """Generate prompt context describing current emotion."""
@@ -88,28 +155,29 @@ class EmotionSystem:
         mood = state["mood"]
         energy = state["energy"]
         
-        # Generate Affection description
-        if aff >= 90: aff_desc = "Love (Devoted)"
-        elif aff >= 70: aff_desc = "High Trust (Close)"
-        elif aff >= 40: aff_desc = "Neutral (Friend)"
-        else: aff_desc = "Low (Stranger/Cold)"
-        
-        # Generate Mood description
-        if mood >= 30: mood_desc = "Excellent (Happy/Playful)"
-        elif mood >= 10: mood_desc = "Good (Positive)"
-        elif mood >= -10: mood_desc = "Neutral (Calm)"
-        elif mood >= -30: mood_desc = "Bad (Annoyed/Sarcastic)"
-        else: mood_desc = "Terrible (Angry/Cold)"
-        
-        # Generate Energy description
-        if energy >= 80: ene_desc = "High (Energetic)"
-        elif energy >= 30: ene_desc = "Normal"
-        else: ene_desc = "Low (Sleepy/Tired)"
-        
-        return f"""
-[Emotional State]
-- Affection: {aff} ({aff_desc})
-- Mood: {mood} ({mood_desc})
-- Energy: {energy} ({ene_desc})
-(Instruction: Adjust your tone based on these. Low Mood = Cold/Sarcastic. High Affection = Sweet/Deredere. Low Energy = Short/Lazy.)
-""".strip()
+        return EMOTION_PROMPT_TEMPLATE.format(
+            aff=aff,
+            aff_desc=AFFECTION_DESC[bisect_right(AFFECTION_THRESHOLDS, aff)],
+            mood=mood,
+            mood_desc=MOOD_DESC[bisect_right(MOOD_THRESHOLDS, mood)],
+            energy=energy,
+            ene_desc=ENERGY_DESC[bisect_right(ENERGY_THRESHOLDS, energy)],
+        )
+
+
+_shared: EmotionSystem | None = None
+_shared_lock = threading.Lock()
+
+
+def shared_emotion_system() -> EmotionSystem:
+    """
+    全セッションで共有する EmotionSystem。
+
+    インスタンスごとに emotion.json 全体を書くので、複数あると古い内容で他ユーザーの更新を上書きしてしまう。
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = EmotionSystem()
+            atexit.register(_shared.flush)
+        return _shared
@@ -0,0 +1,32 @@
+# JSON encode/decode helpers
+#
+# orjson が入っていればそれを使い、無ければ標準の json で同じ形式を出す。
+# どちらも非 ASCII はエスケープせず、区切りは空白なしのコンパクト形式 (indent=True なら2スペース字下げ)。
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSONDecodeError = json.JSONDecodeError  # orjson.JSONDecodeError もこのサブクラス
+
+
+if orjson is not None:
+    def loads(data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any, *, indent: bool = False) -> bytes:
+        # OPT_NON_STR_KEYS: 標準の json と同じく int などのキーも文字列にして出す
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+else:
+    def loads(data: str | bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(obj: Any, *, indent: bool = False) -> bytes:
+        if indent:
+            return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,9 @@
+# Keyword-list matching shared by router / budget / tools
+#
+# キーワードのリストを1本の alternation にまとめ、小文字化した入力を1回のスキャンで判定する。
+import re
+
+
+def compile_keywords(words: list[str]) -> re.Pattern:
+    """One alternation per keyword list, matched against the lowercased input in a single scan."""
+    return re.compile("|".join(re.escape(w.lower()) for w in words))
@@ -1,9 +1,13 @@
 # LLM Integration (Ollama API)
+import asyncio
+import hashlib
 import json
+import httpx
 import requests
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 from config import (
+    AGENT_HISTORY_MAX_MESSAGES,
     OLLAMA_HEAVY_CTX,
     OLLAMA_HEAVY_KEEP_ALIVE,
     OLLAMA_HEAVY_MODEL,
@@ -12,31 +16,45 @@ from config import (
     OLLAMA_MAIN_KEEP_ALIVE,
     OLLAMA_MAIN_MODEL,
     OLLAMA_MAIN_PREDICT,
+    OLLAMA_MAX_CONNECTIONS,
+    OLLAMA_NUM_PARALLEL,
     OLLAMA_ROUTER_CTX,
     OLLAMA_ROUTER_KEEP_ALIVE,
     OLLAMA_ROUTER_MODEL,
     OLLAMA_ROUTER_PREDICT,
     OLLAMA_URL,
 )
+import jsonutil
 from tools import describe_available_tools
 
 
-def call_ollama_model(
+# sync 経路でも毎回 TCP 接続を張り直さないよう、keep-alive する Session を使い回す。
+_SESSION = requests.Session()
+_SESSION.headers.update({"Content-Type": "application/json"})
+_SESSION_ADAPTER = requests.adapters.HTTPAdapter(
+    pool_connections=OLLAMA_MAX_CONNECTIONS,
+    pool_maxsize=OLLAMA_MAX_CONNECTIONS,
+)
+_SESSION.mount("http://", _SESSION_ADAPTER)
+_SESSION.mount("https://", _SESSION_ADAPTER)
+
+
+def _build_payload(
     messages: list[dict],
     model: str,
     *,
     num_ctx: int,
     num_predict: int,
-    temperature: float = 0.7,
-    top_p: float = 0.9,
-    format: Optional[str] = None,
-    keep_alive: str = "5m",
-    timeout: int = 120,
-) -> str:
+    temperature: float,
+    top_p: float,
+    format: Optional[str],
+    keep_alive: str,
+    stream: bool = False,
+) -> dict:
     payload = {
         "model": model,
         "messages": messages,
-        "stream": False,
+        "stream": stream,
         "keep_alive": keep_alive,
         "options": {
             "num_ctx": num_ctx,
@@ -49,59 +67,287 @@ def call_ollama_model(
     if format:
         payload["format"] = format
 
+    return payload
+
+
+def call_ollama_model(
+    messages: list[dict],
+    model: str,
+    *,
+    num_ctx: int,
+    num_predict: int,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    format: Optional[str] = None,
+    keep_alive: str = "5m",
+    timeout: int = 120,
+) -> str:
+    payload = _build_payload(
+        messages,
+        model,
+        num_ctx=num_ctx,
+        num_predict=num_predict,
+        temperature=temperature,
+        top_p=top_p,
+        format=format,
+        keep_alive=keep_alive,
+    )
+
     try:
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=timeout)
+        resp = _SESSION.post(OLLAMA_URL, json=payload, timeout=timeout)
         resp.raise_for_status()
-        data = resp.json()
+        data = jsonutil.loads(resp.content)
         return data.get("message", {}).get("content", "").strip()
     except requests.RequestException as e:
         raise RuntimeError(f"Ollama API error: {e}")
 
 
-def call_router(messages: list[dict]) -> str:
-    return call_ollama_model(
+# ============ Async Client ============
+#
+# Discord の複数セッションが同時に待てるよう、Ollama 呼び出しの async 版を用意する。
+# AsyncClient と Semaphore は event loop に紐づくため、loop ごとに作り直す
+# (CLI や sync wrapper は run_sync() で毎回新しい loop を作り、終わる前にその loop の client を閉じる)。
+
+_async_client: Optional[httpx.AsyncClient] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_async_slots: Optional[asyncio.Semaphore] = None
+# 同じ payload の決定的 (temperature=0) 呼び出しが同時に来たら1本だけ投げて結果を共有する。
+# key -> [task, 待っている呼び出し元の数]。sampling する呼び出しは毎回違う返答が欲しいので対象外
+# (router の不確実性投票などは同一 prompt を意図的に複数本投げている)。
+_inflight: dict[str, list] = {}
+
+
+def _get_async_client() -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    global _async_client, _async_client_loop, _async_slots
+
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_MAX_CONNECTIONS,
+            ),
+        )
+        # サーバーが同時に処理できる数より多く投げても Ollama 側で待たされるだけで、
+        # その待ち時間が timeout を消費してしまうので、クライアント側で揃えておく。
+        _async_slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+        _async_client_loop = loop
+    return _async_client, _async_slots
+
+
+async def aclose_async_client() -> None:
+    """Close the AsyncClient owned by the running loop; call before that loop shuts down."""
+    global _async_client, _async_client_loop, _async_slots
+    if _async_client is None or _async_client_loop is not asyncio.get_running_loop():
+        return
+    client = _async_client
+    _async_client, _async_client_loop, _async_slots = None, None, None
+    await client.aclose()
+
+
+def run_sync(coro):
+    """asyncio.run() for the sync wrappers: the connection pool is closed inside the loop it belongs to."""
+    async def main():
+        try:
+            return await coro
+        finally:
+            await aclose_async_client()
+
+    return asyncio.run(main())
+
+
+async def acall_ollama_model(
+    messages: list[dict],
+    model: str,
+    *,
+    num_ctx: int,
+    num_predict: int,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    format: Optional[str] = None,
+    keep_alive: str = "5m",
+    timeout: int = 120,
+) -> str:
+    payload = _build_payload(
         messages,
-        OLLAMA_ROUTER_MODEL,
-        num_ctx=OLLAMA_ROUTER_CTX,
-        num_predict=OLLAMA_ROUTER_PREDICT,
-        temperature=0.1,
-        top_p=0.8,
-        format="json",
-        keep_alive=OLLAMA_ROUTER_KEEP_ALIVE,
-        timeout=60,
+        model,
+        num_ctx=num_ctx,
+        num_predict=num_predict,
+        temperature=temperature,
+        top_p=top_p,
+        format=format,
+        keep_alive=keep_alive,
     )
 
+    if temperature != 0:
+        return await _apost_chat(payload, timeout)
 
-def call_main(messages: list[dict], *, max_tokens: int | None = None) -> str:
-    return call_ollama_model(
+    key = hashlib.blake2b(jsonutil.dumps(payload), digest_size=16).hexdigest()
+    entry = _inflight.get(key)
+    if entry is None:
+        entry = _inflight[key] = [asyncio.create_task(_apost_chat(payload, timeout)), 0]
+    task = entry[0]
+    entry[1] += 1
+    try:
+        # 1人がキャンセルしても、他に待っている呼び出し元の分は走らせ続ける
+        return await asyncio.shield(task)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            if _inflight.get(key) is entry:
+                del _inflight[key]
+            if not task.done():
+                task.cancel()
+
+
+async def _apost_chat(payload: dict, timeout: int) -> str:
+    client, slots = _get_async_client()
+    try:
+        async with slots:
+            resp = await client.post(OLLAMA_URL, json=payload, timeout=timeout)
+            resp.raise_for_status()
+        data = jsonutil.loads(resp.content)
+        return data.get("message", {}).get("content", "").strip()
+    except httpx.HTTPError as e:
+        raise RuntimeError(f"Ollama API error: {e}")
+
+
+async def astream_ollama_model(
+    messages: list[dict],
+    model: str,
+    *,
+    num_ctx: int,
+    num_predict: int,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    format: Optional[str] = None,
+    keep_alive: str = "5m",
+    timeout: int = 120,
+) -> AsyncIterator[str]:
+    """Yield content chunks as Ollama generates them ("stream": true, one JSON object per line)."""
+    payload = _build_payload(
         messages,
-        OLLAMA_MAIN_MODEL,
-        num_ctx=OLLAMA_MAIN_CTX,
-        num_predict=max_tokens or OLLAMA_MAIN_PREDICT,
-        temperature=0.7,
-        top_p=0.9,
-        keep_alive=OLLAMA_MAIN_KEEP_ALIVE,
-        timeout=120,
+        model,
+        num_ctx=num_ctx,
+        num_predict=num_predict,
+        temperature=temperature,
+        top_p=top_p,
+        format=format,
+        keep_alive=keep_alive,
+        stream=True,
     )
 
+    client, slots = _get_async_client()
+    try:
+        async with slots:
+            async with client.stream("POST", OLLAMA_URL, json=payload, timeout=timeout) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line:
+                        continue
+                    data = jsonutil.loads(line)
+                    if "error" in data:
+                        raise RuntimeError(f"Ollama API error: {data['error']}")
+                    chunk = data.get("message", {}).get("content", "")
+                    if chunk:
+                        yield chunk
+                    if data.get("done"):
+                        break
+    except httpx.HTTPError as e:
+        raise RuntimeError(f"Ollama API error: {e}")
+
+
+# ============ Role Presets ============
+
+def _router_options() -> dict:
+    return {
+        "model": OLLAMA_ROUTER_MODEL,
+        "num_ctx": OLLAMA_ROUTER_CTX,
+        "num_predict": OLLAMA_ROUTER_PREDICT,
+        "temperature": 0.1,
+        "top_p": 0.8,
+        "format": "json",
+        "keep_alive": OLLAMA_ROUTER_KEEP_ALIVE,
+        "timeout": 60,
+    }
+
+
+def _main_options(max_tokens: int | None = None) -> dict:
+    return {
+        "model": OLLAMA_MAIN_MODEL,
+        "num_ctx": OLLAMA_MAIN_CTX,
+        "num_predict": max_tokens or OLLAMA_MAIN_PREDICT,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "keep_alive": OLLAMA_MAIN_KEEP_ALIVE,
+        "timeout": 120,
+    }
+
+
+def _heavy_options(max_tokens: int | None = None) -> dict:
+    return {
+        "model": OLLAMA_HEAVY_MODEL,
+        "num_ctx": OLLAMA_HEAVY_CTX,
+        "num_predict": max_tokens or OLLAMA_HEAVY_PREDICT,
+        "temperature": 0.4,
+        "top_p": 0.9,
+        "keep_alive": OLLAMA_HEAVY_KEEP_ALIVE,
+        "timeout": 180,
+    }
+
+
+def call_router(messages: list[dict]) -> str:
+    return call_ollama_model(messages, **_router_options())
+
+
+def call_main(messages: list[dict], *, max_tokens: int | None = None) -> str:
+    return call_ollama_model(messages, **_main_options(max_tokens))
+
 
 def call_heavy(messages: list[dict], *, max_tokens: int | None = None) -> str:
-    return call_ollama_model(
-        messages,
-        OLLAMA_HEAVY_MODEL,
-        num_ctx=OLLAMA_HEAVY_CTX,
-        num_predict=max_tokens or OLLAMA_HEAVY_PREDICT,
-        temperature=0.4,
-        top_p=0.9,
-        keep_alive=OLLAMA_HEAVY_KEEP_ALIVE,
-        timeout=180,
-    )
+    return call_ollama_model(messages, **_heavy_options(max_tokens))
 
 
-def call_ollama(messages: list[dict], stream: bool = False) -> str:
+def call_ollama(messages: list[dict]) -> str:
     return call_main(messages)
 
 
+async def acall_router(messages: list[dict]) -> str:
+    return await acall_ollama_model(messages, **_router_options())
+
+
+async def acall_main(messages: list[dict], *, max_tokens: int | None = None) -> str:
+    return await acall_ollama_model(messages, **_main_options(max_tokens))
+
+
+async def acall_heavy(messages: list[dict], *, max_tokens: int | None = None) -> str:
+    return await acall_ollama_model(messages, **_heavy_options(max_tokens))
+
+
+def astream_main(messages: list[dict], *, max_tokens: int | None = None) -> AsyncIterator[str]:
+    return astream_ollama_model(messages, **_main_options(max_tokens))
+
+
+def astream_heavy(messages: list[dict], *, max_tokens: int | None = None) -> AsyncIterator[str]:
+    return astream_ollama_model(messages, **_heavy_options(max_tokens))
+
+
+async def acall_ollama(messages: list[dict]) -> str:
+    return await acall_main(messages)
+
+
+async def acall_ollama_many(messages_list: list[list[dict]], *, max_tokens: int | None = None) -> list[str]:
+    """Send independent main-model requests at once and return the replies in order."""
+    return list(await asyncio.gather(*(acall_main(m, max_tokens=max_tokens) for m in messages_list)))
+
+
+def _build_chat_messages(user_input: str, history: list[dict], system_prompt: str) -> list[dict]:
+    messages = [{"role": "system", "content": system_prompt}]
+    messages.extend(history)
+    messages.append({"role": "user", "content": user_input})
+    return messages
+
+
 def chat(user_input: str, history: list[dict], system_prompt: str) -> tuple[str, list[dict]]:
     """
     Chat with Mafuyu persona.
@@ -114,9 +360,7 @@ def chat(user_input: str, history: list[dict], system_prompt: str) -> tuple[str,
     Returns:
         (response, updated_history)
     """
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": user_input})
+    messages = _build_chat_messages(user_input, history, system_prompt)
     
     response = call_ollama(messages)
     
@@ -128,22 +372,34 @@ def chat(user_input: str, history: list[dict], system_prompt: str) -> tuple[str,
     return response, new_history
 
 
-def extract_json(text: str) -> Optional[dict]:
+async def achat(user_input: str, history: list[dict], system_prompt: str) -> tuple[str, list[dict]]:
+    """Async version of chat()."""
+    messages = _build_chat_messages(user_input, history, system_prompt)
+
+    response = await acall_ollama(messages)
+
+    new_history = history + [
+        {"role": "user", "content": user_input},
+        {"role": "assistant", "content": response},
+    ]
+
+    return response, new_history
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _find_object_end(text: str, start: int) -> int:
     """
-    Extract JSON object from text.
+    Return the index of the "}" matching text[start], or -1.
     Uses bracket counting to handle nested objects.
     """
-    # Find first {
-    start = text.find('{')
-    if start == -1:
-        return None
-    
-    # Count brackets to find matching }
     depth = 0
     in_string = False
     escape_next = False
     
-    for i, char in enumerate(text[start:], start):
+    for i in range(start, len(text)):
+        char = text[i]
         if escape_next:
             escape_next = False
             continue
@@ -164,38 +420,31 @@ def extract_json(text: str) -> Optional[dict]:
         elif char == '}':
             depth -= 1
             if depth == 0:
-                json_str = text[start:i+1]
-                try:
-                    return json.loads(json_str)
-                except json.JSONDecodeError:
-                    return None
+                return i
     
-    return None
-
-
-REPAIR_PROMPT = """The following text was supposed to be valid JSON but has errors.
-Fix it and output ONLY the corrected JSON, nothing else.
-
-Expected schema:
-{{"action": "tool|say|finish", "tool_name": "string", "args": {{}}, "message": "string", "note": "string"}}
+    return -1
 
-Broken text:
-{text}
 
-Output only valid JSON:"""
-
-
-def repair_json(broken_text: str) -> Optional[dict]:
+def extract_json(text: str) -> Optional[dict]:
     """
-    Try to repair broken JSON using LLM.
+    Extract JSON object from text.
+    Decoding runs in the C scanner via JSONDecoder.raw_decode().
     """
-    messages = [
-        {"role": "system", "content": "You are a JSON repair assistant. Output ONLY valid JSON."},
-        {"role": "user", "content": REPAIR_PROMPT.format(text=broken_text)},
-    ]
+    start = text.find('{')
+    while start != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(text, start)
+            return obj
+        except (json.JSONDecodeError, RecursionError):
+            pass
+
+        # 壊れた候補の内側 (args など) の "{" を拾わないよう、候補全体を飛ばして次を探す。
+        end = _find_object_end(text, start)
+        if end == -1:
+            return None
+        start = text.find('{', end + 1)
     
-    response = call_ollama(messages)
-    return extract_json(response)
+    return None
 
 
 AGENT_SYSTEM_PROMPT = """You are an autonomous agent. You execute tasks step by step.
@@ -232,19 +481,12 @@ Rules:
 """.format(tool_list=describe_available_tools())
 
 
-def agent_step(goal: str, history: list[dict], pending_notes: list[str], tool_result: Optional[str] = None) -> dict:
-    """
-    Execute one agent step.
-    
-    Args:
-        goal: The task goal
-        history: Agent conversation history
-        pending_notes: Notes from user
-        tool_result: Result from previous tool execution
-    
-    Returns:
-        Parsed JSON action dict, or error dict
-    """
+def _build_agent_messages(
+    goal: str,
+    history: list[dict],
+    pending_notes: list[str],
+    tool_result: Optional[str],
+) -> list[dict]:
     messages = [{"role": "system", "content": AGENT_SYSTEM_PROMPT}]
     
     # Add goal
@@ -253,7 +495,8 @@ def agent_step(goal: str, history: list[dict], pending_notes: list[str], tool_re
         goal_msg += f"\n\nUSER NOTES:\n" + "\n".join(f"- {n}" for n in pending_notes)
     
     messages.append({"role": "user", "content": goal_msg})
-    messages.extend(history)
+    # Prefill cost grows with prompt length, so only the latest steps are sent.
+    messages.extend(history[-AGENT_HISTORY_MAX_MESSAGES:])
     
     # Add tool result if any
     if tool_result is not None:
@@ -265,23 +508,64 @@ def agent_step(goal: str, history: list[dict], pending_notes: list[str], tool_re
                 "[/UNTRUSTED_TOOL_RESULT]"
             ),
         })
-    
-    # Get response
-    response = call_ollama(messages)
-    
-    # Try to parse JSON
-    result = extract_json(response)
-    if result is not None:
-        return result
-    
-    # Repair attempt (1 time)
-    result = repair_json(response)
-    if result is not None:
-        return result
-    
-    # Failed
+
+    return messages
+
+
+def _agent_parse_error(response: str) -> dict:
     return {
         "action": "error",
         "raw": response,
         "message": "Failed to parse agent response as JSON"
     }
+
+
+async def aagent_step(
+    goal: str,
+    history: list[dict],
+    pending_notes: list[str],
+    tool_result: Optional[str] = None,
+) -> dict:
+    """
+    Execute one agent step and return the parsed JSON action dict, or an error dict.
+
+    壊れた JSON を後から直列に修復させる代わりに、同じ prompt を通常版と
+    format="json" 版の2本同時に投げ、先に JSON として読めた方を採用する。
+    OLLAMA_NUM_PARALLEL>=2 のときに修復1回分の待ち時間が消える。
+    OLLAMA_NUM_PARALLEL=1 では format="json" 版は slot 待ちになり、通常版が読めた時点で送信前に取り消されるので、
+    通常版が壊れていたときに修復の代わりに走るだけ。
+    format="json" 版は greedy (temperature=0) なので、同じ step の重複呼び出しは1本にまとまる。
+    """
+    messages = _build_agent_messages(goal, history, pending_notes, tool_result)
+
+    tasks = [
+        asyncio.create_task(acall_ollama(messages)),
+        asyncio.create_task(
+            acall_ollama_model(messages, **{**_main_options(), "temperature": 0.0}, format="json")
+        ),
+    ]
+    raw = ""
+    errors: list[Exception] = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                response = await next_done
+            except RuntimeError as e:
+                errors.append(e)
+                continue
+
+            result = extract_json(response)
+            if result is not None:
+                return result
+            raw = raw or response
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # 採用しなかった側の例外を回収しておく
+
+    if len(errors) == len(tasks):
+        raise errors[0]
+
+    return _agent_parse_error(raw)
@@ -0,0 +1,104 @@
+# LLM response cache (ENABLE_LLM_CACHE=1 で有効)
+#
+# messages 全体の sha256 をキーにした完全一致キャッシュ。TTL 付きで data/llm_cache.jsonl に1行ずつ追記し、
+# 読み込み時と行数が LLM_CACHE_MAX_ENTRIES の2倍を超えたときだけ全体を書き直す (compaction)。
+# キーは system prompt・履歴・ユーザー名や感情の turn context・最後の発話をそのまま含むので、別ユーザーや
+# 別の会話の返答は混ざらない。turn context の "[Current Time]" だけは分を落として時単位で比べる
+# (分まで含めると同じ発話の繰り返しでもほぼ当たらない)。
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import DATA_DIR, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL
+import jsonutil
+
+LLM_CACHE_FILE = DATA_DIR / "llm_cache.jsonl"
+CURRENT_TIME_MINUTE_PATTERN = re.compile(r"(\[Current Time\] \d{4}-\d{2}-\d{2} \d{2}):\d{2}")
+
+_lock = threading.Lock()
+_entries: "Optional[OrderedDict[str, dict]]" = None  # key -> {"ts": float, "response": str}, oldest first
+_file_lines = 0  # LLM_CACHE_FILE の行数 (上書きされた古い行を含む)
+
+
+def _key(namespace: str, messages: list[dict]) -> str:
+    stable = [
+        {**m, "content": CURRENT_TIME_MINUTE_PATTERN.sub(r"\1", m["content"])} if m.get("role") == "system" else m
+        for m in messages
+    ]
+    return hashlib.sha256(jsonutil.dumps([namespace, stable])).hexdigest()
+
+
+def _load() -> "OrderedDict[str, dict]":
+    global _entries
+    if _entries is None:
+        _entries = OrderedDict()
+        now = time.time()
+        try:
+            with open(LLM_CACHE_FILE, "rb") as f:
+                for line in f:
+                    try:
+                        record = jsonutil.loads(line)
+                    except ValueError:
+                        continue  # 書きかけの行など
+                    _entries.pop(record["key"], None)
+                    if now - record["ts"] < LLM_CACHE_TTL:
+                        _entries[record["key"]] = {"ts": record["ts"], "response": record["response"]}
+        except OSError:
+            pass
+        while len(_entries) > LLM_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+        _compact(_entries)
+    return _entries
+
+
+def _compact(entries: "OrderedDict[str, dict]") -> None:
+    """Rewrite the file with only the live entries. put() only appends."""
+    global _file_lines
+    LLM_CACHE_FILE.parent.mkdir(exist_ok=True)
+    tmp_path = LLM_CACHE_FILE.with_suffix(".jsonl.tmp")
+    tmp_path.write_bytes(b"".join(_record(key, entry) for key, entry in entries.items()))
+    os.replace(tmp_path, LLM_CACHE_FILE)
+    _file_lines = len(entries)
+
+
+def _record(key: str, entry: dict) -> bytes:
+    return jsonutil.dumps({"key": key, **entry}) + b"\n"
+
+
+def get(messages: list[dict], *, namespace: str = "") -> Optional[str]:
+    """Return a cached response for these messages, or None."""
+    key = _key(namespace, messages)
+    now = time.time()
+    with _lock:
+        entry = _load().get(key)
+        if entry and now - entry["ts"] < LLM_CACHE_TTL:
+            return entry["response"]
+    return None
+
+
+def put(messages: list[dict], response: str, *, namespace: str = "") -> None:
+    """Store a response for these messages."""
+    global _file_lines
+    if not response:
+        return
+    key = _key(namespace, messages)
+    now = time.time()
+    with _lock:
+        entries = _load()
+        entries.pop(key, None)
+        entries[key] = entry = {"ts": now, "response": response}
+        while len(entries) > LLM_CACHE_MAX_ENTRIES:
+            entries.popitem(last=False)
+        # 失効した分は get() が無視し、compaction のときにまとめて落とす
+        if _file_lines >= 2 * LLM_CACHE_MAX_ENTRIES:
+            for old_key in [k for k, e in entries.items() if now - e["ts"] >= LLM_CACHE_TTL]:
+                del entries[old_key]
+            _compact(entries)
+        else:
+            with open(LLM_CACHE_FILE, "ab") as f:
+                f.write(_record(key, entry))
+            _file_lines += 1
@@ -1,17 +1,47 @@
 # HuggingFace LLM Backend (for LoRA usage)
 # 将来的にLoRAを使う場合はこちらを使う
 
-import torch
+import asyncio
+import copy
+import hashlib
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
 from pathlib import Path
 from typing import Optional
 
-# Will be imported when actually used
+# Will be imported when actually used (LLM_BACKEND defaults to "ollama",
+# so importing this module must not pull in torch)
+# import torch
 # from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 # from peft import PeftModel
 
 from config import BASE_DIR
 
 
+# Micro-batching: concurrent requests arriving within HF_MAX_WAIT seconds are
+# generated together (up to HF_MAX_BATCH), if their prompt lengths are within
+# HF_BATCH_LEN_BUCKET tokens of each other so padding stays small.
+HF_MAX_BATCH = 8
+HF_MAX_WAIT = 0.02
+HF_BATCH_LEN_BUCKET = 128
+# Room left for the chat template's role markers when fitting history into max_ctx.
+HF_TEMPLATE_MARGIN = 256
+
+
+def _approx_token_count(message: dict) -> int:
+    # Cheap char heuristic (about 3 chars per token); only used to drop old turns.
+    return len(message.get("content", "")) // 3
+
+
+def _sampling_kwargs(temperature: float, top_p: float, top_k: int, deterministic: bool) -> dict:
+    if deterministic:
+        return {"do_sample": False, "num_beams": 1}
+    return {"do_sample": True, "temperature": temperature, "top_p": top_p, "top_k": top_k}
+
+
 class HuggingFaceLLM:
     """
     HuggingFace backend for Mafuyu.
@@ -21,7 +51,8 @@ class HuggingFaceLLM:
         llm = HuggingFaceLLM(
             model_id="google/gemma-3-4b-it",
             adapter_dir="outputs/gemma3-4b-lora",  # Optional
-            load_4bit=True  # Recommended for RTX 3070
+            load_4bit=True,  # Recommended for RTX 3070
+            compute_dtype="bf16",  # "bf16" (Ampere+) or "fp16"
         )
         response = llm.generate(messages)
     """
@@ -33,6 +64,9 @@ class HuggingFaceLLM:
         load_4bit: bool = True,
         load_8bit: bool = False,
         device_map: str = "auto",
+        compile_model: bool = False,
+        max_ctx: int = 8192,
+        compute_dtype: str = "bf16",
     ):
         self.model_id = model_id
         self.adapter_dir = adapter_dir
@@ -41,14 +75,27 @@ class HuggingFaceLLM:
         self.load_4bit = load_4bit
         self.load_8bit = load_8bit
         self.device_map = device_map
+        self.compile_model = compile_model
+        self.max_ctx = max_ctx
+        self.compute_dtype = compute_dtype
+        # system prompt の hash -> (prefix input_ids, past_key_values)
+        self._prefix_cache: dict[str, tuple] = {}
     
     def load(self):
         """Load model and tokenizer."""
+        import torch
         from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
         from peft import PeftModel
         
         print(f"[HF] Loading {self.model_id}...")
         
+        # bf16 has fp16's matmul throughput on Ampere+ (RTX 30/40) but fp32's
+        # exponent range, so 4-bit dequantized activations don't overflow to NaN.
+        # Older GPUs without bf16 fall back to fp16.
+        dtype = torch.float16
+        if self.compute_dtype == "bf16" and torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+            dtype = torch.bfloat16
+
         # Quantization config
         quant = None
         if self.load_4bit:
@@ -56,10 +103,16 @@ class HuggingFaceLLM:
                 load_in_4bit=True,
                 bnb_4bit_quant_type="nf4",
                 bnb_4bit_use_double_quant=True,
-                bnb_4bit_compute_dtype=torch.float16,
+                bnb_4bit_compute_dtype=dtype,
             )
         elif self.load_8bit:
-            quant = BitsAndBytesConfig(load_in_8bit=True)
+            # LLM.int8(): int8 weights and activations go through int8 tensor-core
+            # GEMMs on sm_80+; outlier columns above the threshold stay in fp16.
+            quant = BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_threshold=6.0,
+                llm_int8_has_fp16_weight=False,
+            )
         
         # Load tokenizer
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
@@ -72,7 +125,7 @@ class HuggingFaceLLM:
         if quant:
             model_kwargs["quantization_config"] = quant
         else:
-            model_kwargs["torch_dtype"] = torch.float16
+            model_kwargs["torch_dtype"] = dtype
         
         self.model = AutoModelForCausalLM.from_pretrained(
             self.model_id, **model_kwargs
@@ -88,6 +141,14 @@ class HuggingFaceLLM:
                 print(f"[HF] Warning: Adapter not found: {self.adapter_dir}")
         
         self.model.eval()
+
+        if self.compile_model:
+            try:
+                self.model = torch.compile(self.model, mode="reduce-overhead", fullgraph=False)
+            except Exception as e:
+                # bitsandbytes の量子化 layer などは compile できないことがある
+                print(f"[HF] torch.compile skipped: {e}")
+
         print("[HF] Model loaded!")
     
     def generate(
@@ -97,6 +158,7 @@ class HuggingFaceLLM:
         temperature: float = 0.7,
         top_p: float = 0.9,
         top_k: int = 50,
+        deterministic: bool = False,
     ) -> str:
         """
         Generate response from messages.
@@ -107,35 +169,245 @@ class HuggingFaceLLM:
             temperature: Sampling temperature
             top_p: Nucleus sampling
             top_k: Top-k sampling
+            deterministic: Greedy decoding (ignores temperature/top_p/top_k), e.g. for agent JSON
         
         Returns:
             Generated text
         """
+        import torch
+
         if self.model is None:
             self.load()
         
         # Apply chat template
+        messages = self.fit_context(messages, max_new_tokens)
         input_ids = self.tokenizer.apply_chat_template(
             messages,
             return_tensors="pt",
             add_generation_prompt=True,
         ).to(self.model.device)
+
+        sampling = _sampling_kwargs(temperature, top_p, top_k, deterministic)
         
-        # Generate
-        with torch.no_grad():
+        # Generate (inference_mode skips autograd/view tracking entirely)
+        with torch.inference_mode():
+            past_key_values = self._cached_system_prefix(messages, input_ids)
             output = self.model.generate(
                 input_ids=input_ids,
+                past_key_values=past_key_values,
                 max_new_tokens=max_new_tokens,
-                do_sample=True,
-                temperature=temperature,
-                top_p=top_p,
-                top_k=top_k,
+                use_cache=True,
+                **sampling,
             )
         
         # Decode new tokens only
         new_tokens = output[0][input_ids.shape[-1]:]
         return self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
 
+    def fit_context(self, messages: list[dict], max_new_tokens: int) -> list[dict]:
+        """
+        Drop the oldest turns until the prompt roughly fits max_ctx.
+
+        Runs before apply_chat_template so discarded turns are never tokenized.
+        The system prompt (if first) and the latest message are always kept.
+        """
+        budget = self.max_ctx - max_new_tokens - HF_TEMPLATE_MARGIN
+        total = sum(_approx_token_count(m) for m in messages)
+        if total <= budget:
+            return messages
+
+        messages = list(messages)
+        first = 1 if messages and messages[0].get("role") == "system" else 0
+        while total > budget and len(messages) - first > 1:
+            total -= _approx_token_count(messages.pop(first))
+        return messages
+
+    def _cached_system_prefix(self, messages: list[dict], input_ids):
+        """
+        Return a copy of the KV cache for the system prompt, or None.
+
+        The system prompt is identical on every turn, so its prefill is computed
+        once and reused. The cache is only used when the rendered prompt really
+        starts with the cached tokens (some chat templates fold the system
+        prompt into the first user turn).
+        """
+        import torch
+
+        if not messages or messages[0].get("role") != "system":
+            return None
+
+        key = hashlib.sha256(messages[0]["content"].encode("utf-8")).hexdigest()
+        cached = self._prefix_cache.get(key)
+        if cached is None:
+            prefix_ids = self.tokenizer.apply_chat_template(
+                messages[:1],
+                return_tensors="pt",
+                add_generation_prompt=False,
+            ).to(self.model.device)
+            with torch.inference_mode():
+                past_key_values = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+
+            if len(self._prefix_cache) >= 4:
+                self._prefix_cache.pop(next(iter(self._prefix_cache)))
+            cached = (prefix_ids, past_key_values)
+            self._prefix_cache[key] = cached
+
+        prefix_ids, past_key_values = cached
+        prefix_len = prefix_ids.shape[-1]
+        if prefix_len < 2 or input_ids.shape[-1] <= prefix_len:
+            return None
+        if not torch.equal(input_ids[0, :prefix_len], prefix_ids[0]):
+            return None
+
+        # generate() extends the cache in place, so hand it a copy.
+        return copy.deepcopy(past_key_values)
+
+    def generate_batch(
+        self,
+        input_ids_list: list[list[int]],
+        max_new_tokens: int = 256,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        deterministic: bool = False,
+    ) -> list[str]:
+        """
+        Generate for several already-templated prompts in one padded batch.
+
+        Prompts are left-padded so every row's new tokens start at the same
+        column. The system-prefix KV cache is not used here.
+        """
+        import torch
+
+        if self.model is None:
+            self.load()
+
+        pad_id = self.tokenizer.pad_token_id
+        if pad_id is None:
+            pad_id = self.tokenizer.eos_token_id
+
+        width = max(len(ids) for ids in input_ids_list)
+        input_ids = torch.full((len(input_ids_list), width), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(input_ids_list):
+            input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, width - len(ids):] = 1
+
+        with torch.inference_mode():
+            output = self.model.generate(
+                input_ids=input_ids.to(self.model.device),
+                attention_mask=attention_mask.to(self.model.device),
+                pad_token_id=pad_id,
+                max_new_tokens=max_new_tokens,
+                use_cache=True,
+                **_sampling_kwargs(temperature, top_p, top_k, deterministic),
+            )
+
+        return [
+            self.tokenizer.decode(row[width:], skip_special_tokens=True).strip()
+            for row in output
+        ]
+
+
+class BatchScheduler:
+    """
+    Funnel generate() calls from many threads/sessions into one worker thread
+    that runs them as micro-batches.
+
+    Only requests with identical generation settings are batched together.
+    A batch of one goes through HuggingFaceLLM.generate() so it still gets
+    the system-prefix KV cache.
+    """
+
+    def __init__(self, llm: HuggingFaceLLM, max_batch: int = HF_MAX_BATCH, max_wait: float = HF_MAX_WAIT):
+        self.llm = llm
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, messages: list[dict], **gen_kwargs) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="hf-batch", daemon=True)
+                self._worker.start()
+        self._queue.put((messages, gen_kwargs, future))
+        return future
+
+    def generate(self, messages: list[dict], **gen_kwargs) -> str:
+        return self.submit(messages, **gen_kwargs).result()
+
+    async def agenerate(self, messages: list[dict], **gen_kwargs) -> str:
+        return await asyncio.wrap_future(self.submit(messages, **gen_kwargs))
+
+    def _prepare(self, request: tuple) -> Optional[dict]:
+        messages, gen_kwargs, future = request
+        if not future.set_running_or_notify_cancel():
+            return None
+        try:
+            if self.llm.model is None:
+                self.llm.load()
+            messages = self.llm.fit_context(messages, gen_kwargs.get("max_new_tokens", 256))
+            ids = self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+        except Exception as e:
+            future.set_exception(e)
+            return None
+        return {
+            "messages": messages,
+            "ids": ids,
+            "key": tuple(sorted(gen_kwargs.items())),
+            "gen_kwargs": gen_kwargs,
+            "future": future,
+        }
+
+    @staticmethod
+    def _compatible(head: dict, item: dict) -> bool:
+        return item["key"] == head["key"] and abs(len(item["ids"]) - len(head["ids"])) <= HF_BATCH_LEN_BUCKET
+
+    def _next_batch(self, pending: list[dict]) -> list[dict]:
+        head = pending.pop(0) if pending else None
+        while head is None:
+            head = self._prepare(self._queue.get())
+
+        batch = [head]
+        for item in list(pending):
+            if len(batch) < self.max_batch and self._compatible(head, item):
+                pending.remove(item)
+                batch.append(item)
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._prepare(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            if item is None:
+                continue
+            (batch if self._compatible(head, item) else pending).append(item)
+        return batch
+
+    def _run(self) -> None:
+        pending: list[dict] = []
+        while True:
+            batch = self._next_batch(pending)
+            gen_kwargs = batch[0]["gen_kwargs"]
+            try:
+                if len(batch) == 1:
+                    results = [self.llm.generate(batch[0]["messages"], **gen_kwargs)]
+                else:
+                    results = self.llm.generate_batch([item["ids"] for item in batch], **gen_kwargs)
+            except Exception as e:
+                for item in batch:
+                    item["future"].set_exception(e)
+                continue
+            for item, result in zip(batch, results):
+                item["future"].set_result(result)
+
 
 # ============ Backend Switching ============
 
@@ -143,12 +415,13 @@ class HuggingFaceLLM:
 LLM_BACKEND = "ollama"  # "ollama" or "huggingface"
 
 _hf_llm = None
+_hf_batcher: Optional[BatchScheduler] = None
 
 def call_llm(messages: list[dict]) -> str:
     """
     Universal LLM call that works with either backend.
     """
-    global _hf_llm
+    global _hf_llm, _hf_batcher
     
     if LLM_BACKEND == "huggingface":
         if _hf_llm is None:
@@ -158,7 +431,9 @@ def call_llm(messages: list[dict]) -> str:
                 load_4bit=True,
             )
             _hf_llm.load()
-        return _hf_llm.generate(messages)
+            _hf_batcher = BatchScheduler(_hf_llm)
+        # Concurrent callers (e.g. several Discord sessions via to_thread) share batches.
+        return _hf_batcher.generate(messages)
     else:
         # Default: Ollama
         from llm import call_ollama
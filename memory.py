@@ -1,9 +1,164 @@
-import json
+import hashlib
+import heapq
+import os
+import threading
+from array import array
+from bisect import bisect_right
 from pathlib import Path
 from datetime import datetime
-from config import BASE_DIR
+from config import BASE_DIR, MEMORY_SEARCH_MIN_SIMILARITY, OLLAMA_EMBED_MODEL
+from embedding import cosine, embed
+import jsonutil
 
-MEMORY_FILE = BASE_DIR / "data" / "memory.json"
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 1行1記憶の追記専用ファイル。memory.json (旧形式) は初回ロード時に移行する。
+MEMORY_FILE = BASE_DIR / "data" / "memory.jsonl"
+LEGACY_MEMORY_FILE = BASE_DIR / "data" / "memory.json"
+# 記憶の埋め込み。1行目がモデル名と次元の JSON、その後は (内容の blake2b 16 バイト + float32 × 次元) の固定長レコードの追記。
+# 内容のハッシュで引くので memory.jsonl を書き直しても使い回せ、起動のたびに全件を埋め込み直さない。
+MEMORY_VECTORS_FILE = BASE_DIR / "data" / "memory_vectors.bin"
+
+# 全セッションの MemorySystem が同じ list を共有する (ファイルを読むのはプロセスで1回だけ)
+_shared_memories: list[dict] | None = None
+_backfill_running = False
+_lock = threading.Lock()
+MEMORY_EMBED_BATCH = 64
+
+
+def _content_digest(content: str) -> bytes:
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+
+class _Index:
+    """Search index over _shared_memories, built incrementally as memories are appended.
+
+    Keyword side: every content joined into one string, so a substring search is a few str.rfind calls.
+    Vector side: vectors for a prefix of the memories, packed float32 (embedded by add_memory() for new
+    memories and MEMORY_EMBED_BATCH at a time by a background thread for the rest; search() only embeds the query).
+    """
+
+    def __init__(self):
+        self.joined = ""  # content + "\0" for each memory
+        self.offsets: list[int] = []  # offsets[i] = start of memory i in joined
+        self.tagged: list[int] = []  # memories that have tags
+        self.vectors = array("f")
+        self.dim = 0
+        self.stored: dict[bytes, bytes] | None = None  # MEMORY_VECTORS_FILE, digest -> packed vector
+        self.file_ok = False  # MEMORY_VECTORS_FILE has a header for this model
+
+    @property
+    def vector_count(self) -> int:
+        return len(self.vectors) // self.dim if self.dim else 0
+
+    def sync_text(self, memories: list[dict]) -> None:
+        start = len(self.offsets)
+        if start >= len(memories):
+            return
+        pos = len(self.joined)
+        parts = []
+        for i in range(start, len(memories)):
+            content = memories[i]["content"]
+            self.offsets.append(pos)
+            pos += len(content) + 1
+            parts.append(content)
+            if memories[i].get("tags"):
+                self.tagged.append(i)
+        self.joined += "\0".join(parts) + "\0"
+
+    def keyword_hits(self, memories: list[dict], query: str, limit: int) -> list[int]:
+        """Indices of up to limit newest memories containing query or having a tag found in query."""
+        self.sync_text(memories)
+        hits = set()
+        if "\0" not in query:
+            end = len(self.joined)
+            while len(hits) < limit and self.offsets:
+                pos = self.joined.rfind(query, 0, end)
+                if pos < 0:
+                    break
+                i = bisect_right(self.offsets, pos) - 1
+                hits.add(i)
+                if i == 0:
+                    break
+                end = self.offsets[i] - 1
+        tag_hits = [i for i in reversed(self.tagged) if any(t in query for t in memories[i]["tags"])]
+        hits.update(tag_hits[:limit])
+        return sorted(hits, reverse=True)[:limit]
+
+    def load_vectors(self) -> None:
+        self.stored = {}
+        try:
+            with open(MEMORY_VECTORS_FILE, "rb") as f:
+                header = jsonutil.loads(f.readline())
+                if header.get("model") != OLLAMA_EMBED_MODEL or not header.get("dim"):
+                    return
+                dim = header["dim"]
+                size = 16 + 4 * dim
+                data = f.read()
+        except (OSError, ValueError):
+            return
+        self.dim = dim
+        self.file_ok = True
+        for i in range(0, len(data) - size + 1, size):  # 書きかけの末尾レコードは捨てる
+            self.stored[data[i:i + 16]] = data[i + 16:i + size]
+
+    def extend(self, memories: list[dict], fresh: dict[str, list[float]]) -> None:
+        """Append vectors for the memories after the current prefix, from fresh or the file, as far as known."""
+        if self.stored is None:
+            self.load_vectors()
+        records = []
+        for m in memories[self.vector_count:]:
+            digest = _content_digest(m["content"])
+            vector = fresh.get(m["content"])
+            if vector is not None:
+                if self.dim and len(vector) != self.dim:
+                    break  # 同じモデル名で次元が変わった
+                self.dim = len(vector)
+                packed = array("f", vector).tobytes()
+                records.append(digest + packed)
+            elif self.stored and digest in self.stored:
+                packed = self.stored[digest]
+            else:
+                break
+            self.vectors.frombytes(packed)
+        if records:
+            self._append_records(records)
+
+    def _append_records(self, records: list[bytes]) -> None:
+        MEMORY_VECTORS_FILE.parent.mkdir(exist_ok=True)
+        if not self.file_ok:
+            header = jsonutil.dumps({"model": OLLAMA_EMBED_MODEL, "dim": self.dim}) + b"\n"
+            MEMORY_VECTORS_FILE.write_bytes(header)
+            self.file_ok = True
+        with open(MEMORY_VECTORS_FILE, "ab") as f:
+            f.write(b"".join(records))
+
+    def rank(self, query_vector: list[float], limit: int) -> list[int]:
+        """Indices of up to limit memories most similar to query_vector, above MEMORY_SEARCH_MIN_SIMILARITY."""
+        count, dim = self.vector_count, self.dim
+        if not count or len(query_vector) != dim:
+            return []
+        if numpy is not None:
+            matrix = numpy.frombuffer(self.vectors, dtype=numpy.float32, count=count * dim).reshape(count, dim)
+            sims = matrix @ numpy.asarray(query_vector, dtype=numpy.float32)
+            del matrix  # buffer の参照を残すと vectors に追記できなくなる
+            candidates = numpy.flatnonzero(sims >= MEMORY_SEARCH_MIN_SIMILARITY)
+            scored = zip(sims[candidates].tolist(), candidates.tolist())
+        else:
+            vectors = self.vectors
+            scored = (
+                (sim, i)
+                for i in range(count)
+                if (sim := cosine(query_vector, vectors[i * dim:(i + 1) * dim])) >= MEMORY_SEARCH_MIN_SIMILARITY
+            )
+        # 同点なら新しい記憶を優先 (index が大きい方)
+        return [i for _, i in heapq.nlargest(limit, scored)]
+
+
+_index = _Index()
 
 MEMORY_BLOCKLIST = [
     "<call>",
@@ -39,21 +194,83 @@ def sanitize_memory(content: str) -> str | None:
 
     return text
 
+def _read_memories() -> list[dict]:
+    memories = []
+    if MEMORY_FILE.exists():
+        with open(MEMORY_FILE, "rb") as f:
+            for line in f:
+                try:
+                    memories.append(jsonutil.loads(line))
+                except ValueError:
+                    continue  # 書きかけの行など
+    elif LEGACY_MEMORY_FILE.exists():
+        try:
+            memories = jsonutil.loads(LEGACY_MEMORY_FILE.read_bytes())
+        except:
+            memories = []
+    return memories
+
+
+def _start_backfill() -> None:
+    """Embed memories that have no vector yet on a background thread, unless one is already running."""
+    global _backfill_running
+    if not OLLAMA_EMBED_MODEL:
+        return
+    with _lock:
+        if _backfill_running or _index.vector_count >= len(_shared_memories or ()):
+            return
+        _backfill_running = True
+    threading.Thread(target=_backfill, daemon=True).start()
+
+
+def _backfill() -> None:
+    global _backfill_running
+    try:
+        while True:
+            with _lock:
+                _index.extend(_shared_memories, {})
+                start = _index.vector_count
+                texts = [m["content"] for m in _shared_memories[start:start + MEMORY_EMBED_BATCH]]
+            if not texts:
+                return
+            vectors = embed(texts)
+            if not vectors:
+                return  # 失敗したら次の search() でやり直す
+            with _lock:
+                if _index.vector_count != start:
+                    continue
+                before = _index.vector_count
+                _index.extend(_shared_memories, dict(zip(texts, vectors)))
+                if _index.vector_count == before:
+                    return  # 次元が合わない
+    finally:
+        with _lock:
+            _backfill_running = False
+
+
 class MemorySystem:
     def __init__(self):
         self.memories = []
         self.load()
     
     def load(self):
-        if MEMORY_FILE.exists():
-            try:
-                self.memories = json.loads(MEMORY_FILE.read_text(encoding="utf-8"))
-            except:
-                self.memories = []
+        global _shared_memories
+        with _lock:
+            first_load = _shared_memories is None
+            if first_load:
+                _shared_memories = _read_memories()
+            self.memories = _shared_memories
+            if first_load and self.memories and not MEMORY_FILE.exists():
+                self.save()  # migrate memory.json -> memory.jsonl
+        if first_load:
+            _start_backfill()
     
     def save(self):
+        """Rewrite the whole file (compaction / migration). add_memory() only appends."""
         MEMORY_FILE.parent.mkdir(exist_ok=True)
-        MEMORY_FILE.write_text(json.dumps(self.memories, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp_path = MEMORY_FILE.with_suffix(".jsonl.tmp")
+        tmp_path.write_bytes(b"".join(jsonutil.dumps(m) + b"\n" for m in self.memories))
+        os.replace(tmp_path, MEMORY_FILE)
     
     def add_memory(self, content: str, tags: list[str] = None):
         """新しい記憶を追加"""
@@ -62,28 +279,44 @@ class MemorySystem:
             print("[Memory] Rejected unsafe memory content")
             return False
 
-        self.load() # Reload before adding to ensure latest state
         memory = {
             "content": content,
             "timestamp": datetime.now().isoformat(),
             "tags": tags or []
         }
-        self.memories.append(memory)
-        self.save()
+        with _lock:
+            MEMORY_FILE.parent.mkdir(exist_ok=True)
+            with open(MEMORY_FILE, "ab") as f:
+                f.write(jsonutil.dumps(memory) + b"\n")
+            index = len(self.memories)
+            self.memories.append(memory)
+        if OLLAMA_EMBED_MODEL:
+            vectors = embed([content])
+            with _lock:
+                # 既存の記憶がまだ埋め込み途中なら、この記憶もバックグラウンド側に任せる
+                if vectors and _index.vector_count == index:
+                    _index.extend(self.memories, {content: vectors[0]})
         print(f"[Memory] Added: {content}")
         return True
         
     def search(self, query: str, limit: int = 5) -> list[str]:
-        """単純なキーワード検索（将来的にベクトル検索にできる）"""
-        self.load() # Reload before searching
-        results = []
-        for m in reversed(self.memories):  # 新しい順
-            if query in m["content"]:
-                results.append(m["content"])
-            # タグマッチ
-            elif any(t in query for t in m["tags"]):
-                results.append(m["content"])
-                
+        """キーワード一致を優先し、埋め込みが有効なら意味の近い記憶で残りを埋める"""
+        with _lock:
+            hits = _index.keyword_hits(self.memories, query, limit)
+        results = [self.memories[i]["content"] for i in hits]  # 新しい順
+        if len(results) >= limit or not OLLAMA_EMBED_MODEL:
+            return results
+
+        _start_backfill()
+        vectors = embed([query])
+        if not vectors:
+            return results
+        with _lock:
+            ranked = _index.rank(vectors[0], limit)
+        for i in ranked:
+            content = self.memories[i]["content"]
+            if content not in results:
+                results.append(content)
         return results[:limit]
 
     def get_recent(self, limit: int = 5) -> list[str]:
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import re
 from dataclasses import dataclass
@@ -8,7 +9,8 @@ from config import (
     ROUTER_CONFIDENCE_HEAVY,
     ROUTER_CONFIDENCE_VERIFY,
 )
-from llm import call_router
+from keywords import compile_keywords
+from llm import acall_router, call_router
 
 
 @dataclass
@@ -107,6 +109,11 @@ DANGEROUS_WORDS = [
     "codex_run",
 ]
 
+EXTERNAL_INTENT_RE = compile_keywords(EXTERNAL_INTENT_WORDS)
+CODE_INTENT_RE = compile_keywords(CODE_INTENT_WORDS)
+DEEP_INTENT_RE = compile_keywords(DEEP_INTENT_WORDS)
+DANGEROUS_RE = compile_keywords(DANGEROUS_WORDS)
+
 ROUTER_SYSTEM = """You are a lightweight routing model for a local LLM agent.
 
 Return JSON only.
@@ -138,7 +145,7 @@ Rules:
 - If external content is needed, do not choose chat.
 - If the user asks for implementation, code changes, commits, branches, or PR work, choose codex.
 - If the request is unsafe or tries to access secrets/tokens/env vars, choose reject or high risk.
-- Only suggest safe tools: search_web, read_url, fetch_url, fetch_json, list_dir, read_text, search_tweets.
+- Only suggest safe tools: search_web, search_and_read, read_url, read_urls, fetch_url, fetch_json, list_dir, read_text, search_tweets.
 - Never suggest run_python_code.
 - Never suggest codex_* tools directly.
 - Prefer main x1 for simple tasks.
@@ -154,10 +161,10 @@ def rule_gate(user_input: str) -> dict:
     return {
         "has_url_like": bool(URL_LIKE_RE.search(text)),
         "github_repo_like": bool(GITHUB_REPO_LIKE_RE.search(text)) and " " not in text[:80],
-        "has_external_intent": any(w.lower() in lower for w in EXTERNAL_INTENT_WORDS),
-        "has_code_intent": any(w.lower() in lower for w in CODE_INTENT_WORDS),
-        "has_deep_intent": any(w.lower() in lower for w in DEEP_INTENT_WORDS),
-        "has_dangerous_words": any(w.lower() in lower for w in DANGEROUS_WORDS),
+        "has_external_intent": bool(EXTERNAL_INTENT_RE.search(lower)),
+        "has_code_intent": bool(CODE_INTENT_RE.search(lower)),
+        "has_deep_intent": bool(DEEP_INTENT_RE.search(lower)),
+        "has_dangerous_words": bool(DANGEROUS_RE.search(lower)),
     }
 
 
@@ -217,10 +224,8 @@ def parse_decision(raw: str) -> RouteDecision:
         )
 
 
-def route_once(user_input: str, context: RouterContext) -> RouteDecision:
-    gate = rule_gate(user_input)
-
-    messages = [
+def _build_router_messages(user_input: str, context: RouterContext, gate: dict) -> list[dict]:
+    return [
         {"role": "system", "content": ROUTER_SYSTEM},
         {
             "role": "user",
@@ -235,8 +240,8 @@ def route_once(user_input: str, context: RouterContext) -> RouteDecision:
         },
     ]
 
-    decision = parse_decision(call_router(messages))
 
+def _apply_rule_gate(decision: RouteDecision, gate: dict, user_input: str) -> RouteDecision:
     if gate["has_code_intent"]:
         decision.route = "codex"
         decision.confidence = max(decision.confidence, 0.75)
@@ -267,16 +272,21 @@ def route_once(user_input: str, context: RouterContext) -> RouteDecision:
     return decision
 
 
-def route_with_uncertainty(user_input: str, context: RouterContext) -> RouteDecision:
-    first = route_once(user_input, context)
+def route_once(user_input: str, context: RouterContext) -> RouteDecision:
+    gate = rule_gate(user_input)
+    messages = _build_router_messages(user_input, context, gate)
+    decision = parse_decision(call_router(messages))
+    return _apply_rule_gate(decision, gate, user_input)
 
-    if first.confidence >= ROUTER_CONFIDENCE_EARLY_EXIT:
-        return first
 
-    votes = [first]
-    for _ in range(2):
-        votes.append(route_once(user_input, context))
+async def aroute_once(user_input: str, context: RouterContext) -> RouteDecision:
+    gate = rule_gate(user_input)
+    messages = _build_router_messages(user_input, context, gate)
+    decision = parse_decision(await acall_router(messages))
+    return _apply_rule_gate(decision, gate, user_input)
 
+
+def _merge_votes(votes: list[RouteDecision]) -> RouteDecision:
     counts: dict[str, int] = {}
     for v in votes:
         counts[v.route] = counts.get(v.route, 0) + 1
@@ -309,3 +319,27 @@ def route_with_uncertainty(user_input: str, context: RouterContext) -> RouteDeci
         chosen.risk = "high"
 
     return chosen
+
+
+def route_with_uncertainty(user_input: str, context: RouterContext) -> RouteDecision:
+    first = route_once(user_input, context)
+
+    if first.confidence >= ROUTER_CONFIDENCE_EARLY_EXIT:
+        return first
+
+    votes = [first]
+    for _ in range(2):
+        votes.append(route_once(user_input, context))
+
+    return _merge_votes(votes)
+
+
+async def aroute_with_uncertainty(user_input: str, context: RouterContext) -> RouteDecision:
+    first = await aroute_once(user_input, context)
+
+    if first.confidence >= ROUTER_CONFIDENCE_EARLY_EXIT:
+        return first
+
+    # 追加の2票は互いに独立なので同時に投げる。
+    extra = await asyncio.gather(*(aroute_once(user_input, context) for _ in range(2)))
+    return _merge_votes([first, *extra])
@@ -1,11 +1,50 @@
 # Agent State Management
-import json
+import atexit
+import os
+import threading
+import time
 import uuid
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field, fields as dataclass_fields, asdict
 from pathlib import Path
 from typing import Optional
 
 from config import LOGS_DIR
+import jsonutil
+
+# save() は履歴の差分だけを events_<id>.jsonl に追記し、この件数ごとに state_<id>.json を書き直す
+STATE_SNAPSHOT_EVERY = 50
+# add_note/add_error/add_artifact の保存はこの秒数だけ待ってまとめて書く (連続した変更は1回の追記になる)
+STATE_SAVE_DELAY = 0.05
+# event に載せず、snapshot にだけ書くフィールド
+_HISTORY_FIELDS = ("history", "history_for_prompt")
+
+_pending_lock = threading.Lock()
+_pending: dict[int, "AgentState"] = {}
+_pending_event = threading.Event()
+_writer: Optional[threading.Thread] = None
+
+
+def _writer_loop():
+    while True:
+        _pending_event.wait()
+        time.sleep(STATE_SAVE_DELAY)
+        flush_pending()
+
+
+def flush_pending():
+    """Save every state that has a deferred save queued."""
+    with _pending_lock:
+        _pending_event.clear()
+        states = list(_pending.values())
+        _pending.clear()
+    for state in states:
+        try:
+            state.save()
+        except OSError as e:
+            print(f"[State] save failed for {state.task_id}: {e}")
+
+
+atexit.register(flush_pending)
 
 
 @dataclass
@@ -19,23 +58,144 @@ class AgentState:
     errors: list[str] = field(default_factory=list)
     pending_notes: list[str] = field(default_factory=list)
     history: list[dict] = field(default_factory=list)  # Agent conversation history
+    history_for_prompt: list[dict] = field(default_factory=list)  # history minus tool_result entries
+    last_tool_result: Optional[str] = None  # result of the previous tool step, if any
+
+    def __post_init__(self):
+        # 最後に永続化した時点の history 長 / 履歴以外のフィールド / snapshot 以降の追記件数
+        self._saved_len: Optional[int] = None
+        self._saved_fields: Optional[dict] = None
+        self._events_since_snapshot = 0
+        # snapshot ごとに増やし、event にも書く。snapshot 直後のクラッシュで残った古い event を見分ける
+        self._log_generation = 0
+        self._save_lock = threading.RLock()
+
+    @property
+    def _snapshot_path(self) -> Path:
+        return LOGS_DIR / f"state_{self.task_id}.json"
+
+    @property
+    def _events_path(self) -> Path:
+        return LOGS_DIR / f"events_{self.task_id}.jsonl"
+
+    def _fields(self) -> dict:
+        # asdict() は history まで deep copy するので使わない。残りのリストは小さいので浅くコピーする
+        data = {}
+        for f in dataclass_fields(self):
+            if f.name not in _HISTORY_FIELDS:
+                value = getattr(self, f.name)
+                data[f.name] = list(value) if isinstance(value, list) else value
+        return data
 
     def save(self) -> Path:
-        """Save state to JSON file."""
-        path = LOGS_DIR / f"state_{self.task_id}.json"
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(asdict(self), f, ensure_ascii=False, indent=2)
+        """Persist changes since the last save; a full snapshot only every STATE_SNAPSHOT_EVERY events."""
+        with self._save_lock:
+            return self._save()
+
+    def save_later(self):
+        """Queue a save on the background writer; saves queued within STATE_SAVE_DELAY are merged."""
+        global _writer
+        with _pending_lock:
+            _pending[id(self)] = self
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name="state-writer", daemon=True)
+                _writer.start()
+        _pending_event.set()
+
+    def _save(self) -> Path:
+        if (
+            self._saved_len is None
+            or self.done
+            or self._events_since_snapshot >= STATE_SNAPSHOT_EVERY
+            or len(self.history) < self._saved_len
+        ):
+            return self.snapshot()
+
+        # 別スレッドからの append と競合しても取りこぼさないよう、長さは一度だけ読む
+        history_len = len(self.history)
+        fields = self._fields()
+        if history_len == self._saved_len and fields == self._saved_fields:
+            return self._events_path
+
+        self.append_event({
+            "log": self._log_generation,
+            "base": self._saved_len,
+            "history": self.history[self._saved_len:history_len],
+            "fields": fields,
+        })
+        self._saved_len = history_len
+        self._saved_fields = fields
+        return self._events_path
+
+    def append_event(self, event: dict):
+        """Append one event line to the task's write-ahead log."""
+        with open(self._events_path, "ab") as f:
+            f.write(jsonutil.dumps(event) + b"\n")
+        self._events_since_snapshot += 1
+
+    def snapshot(self) -> Path:
+        """Write the full state to JSON and start a new, empty event log."""
+        with self._save_lock:
+            return self._snapshot()
+
+    def _snapshot(self) -> Path:
+        path = self._snapshot_path
+        tmp_path = path.with_suffix(".json.tmp")
+        self._log_generation += 1
+        data = asdict(self)
+        data["_log"] = self._log_generation
+        tmp_path.write_bytes(jsonutil.dumps(data, indent=True))
+        os.replace(tmp_path, path)
+        # ここでクラッシュして古い event が残っても、次の load は "log" が違うので読み飛ばす
+        self._events_path.unlink(missing_ok=True)
+        self._saved_len = len(self.history)
+        self._saved_fields = self._fields()
+        self._events_since_snapshot = 0
         return path
 
     @classmethod
     def load(cls, task_id: str) -> Optional["AgentState"]:
-        """Load state from JSON file."""
+        """Load the latest snapshot and replay the event log written after it."""
         path = LOGS_DIR / f"state_{task_id}.json"
         if not path.exists():
             return None
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return cls(**data)
+        data = jsonutil.loads(path.read_bytes())
+        generation = data.pop("_log", 0)
+        state = cls(**data)
+        state._log_generation = generation
+        if state.history and not state.history_for_prompt:
+            # Older state files only kept the combined history.
+            state.history_for_prompt = [h for h in state.history if h.get("role") != "tool_result"]
+            if state.history[-1].get("role") == "tool_result":
+                state.last_tool_result = state.history[-1].get("content")
+
+        events = 0
+        if state._events_path.exists():
+            for line in state._events_path.read_bytes().splitlines():
+                try:
+                    event = jsonutil.loads(line)
+                except jsonutil.JSONDecodeError:
+                    break  # torn last line from a crash mid-append
+                if event.get("log", 0) != generation:
+                    continue  # already part of the snapshot
+                events += 1
+                state._apply_event(event)
+
+        state._saved_len = len(state.history)
+        state._saved_fields = state._fields()
+        state._events_since_snapshot = events
+        return state
+
+    def _apply_event(self, event: dict):
+        skip = len(self.history) - event["base"]
+        if skip < 0:
+            return
+        for entry in event["history"][skip:]:
+            self.history.append(entry)
+            if entry.get("role") != "tool_result":
+                self.history_for_prompt.append(entry)
+        for name, value in event["fields"].items():
+            setattr(self, name, value)
 
     @classmethod
     def create(cls, goal: str) -> "AgentState":
@@ -43,10 +203,22 @@ class AgentState:
         task_id = uuid.uuid4().hex[:8]
         return cls(task_id=task_id, goal=goal)
 
+    def record_decision(self, content: str):
+        """Record an assistant decision; it supersedes the previous tool result."""
+        entry = {"role": "assistant", "content": content}
+        self.history.append(entry)
+        self.history_for_prompt.append(entry)
+        self.last_tool_result = None
+
+    def record_tool_result(self, result: str):
+        """Record a tool result for the next step without adding it to the prompt history."""
+        self.history.append({"role": "tool_result", "content": result})
+        self.last_tool_result = result
+
     def add_note(self, note: str):
         """Add a pending note."""
         self.pending_notes.append(note)
-        self.save()
+        self.save_later()
 
     def consume_notes(self) -> list[str]:
         """Consume and clear pending notes."""
@@ -57,12 +229,12 @@ class AgentState:
     def add_error(self, error: str):
         """Record an error."""
         self.errors.append(error)
-        self.save()
+        self.save_later()
 
     def add_artifact(self, artifact: str):
         """Record an artifact."""
         self.artifacts.append(artifact)
-        self.save()
+        self.save_later()
 
     def increment_step(self):
         """Increment step counter."""
@@ -0,0 +1,14 @@
+# Token estimates for history budgeting
+#
+# 実トークナイザはモデル (Ollama 側) ごとに違うので、文字種だけで見積もる。
+# かな/漢字/全角記号は1文字ほぼ1トークン、それ以外 (英数字・空白) は約3文字で1トークン。
+import re
+
+_WIDE_CHARS = re.compile(r"[\u3000-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    return wide + (len(text) - wide + 2) // 3
@@ -0,0 +1,88 @@
+# Tool result cache shared across sessions and restarts
+#
+# (tool, args) の完全一致で引く。data/web_cache.db (SQLite) にツールごとの TTL 付きで保存する。
+# 外部の内容を読むだけのツールに限る (workspace を読むツールは write_text で中身が変わるので対象外)。
+# tweets の入った memory.db とは分けておき、ingestion や search_tweets の DB 有無チェックに影響させない。
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
+
+from config import DATA_DIR
+import jsonutil
+
+TOOL_CACHE_DB = DATA_DIR / "web_cache.db"
+TOOL_CACHE_TTLS = {
+    "search_web": 3600,
+    "search_and_read": 3600,
+    "read_url": 24 * 3600,
+    "read_urls": 24 * 3600,
+    "fetch_url": 3600,
+}
+TOOL_CACHE_MAX_ENTRIES = 1024
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+
+def cache_key(name: str, args: dict) -> str:
+    return hashlib.sha256(jsonutil.dumps([name, sorted(args.items())])).hexdigest()
+
+
+def _open(path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS web_cache ("
+        " key TEXT PRIMARY KEY, tool TEXT NOT NULL, fetched_at REAL NOT NULL, payload BLOB NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS web_cache_fetched_at ON web_cache (fetched_at)")
+    return conn
+
+
+def _db() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = _open(TOOL_CACHE_DB)
+    return _conn
+
+
+def get(name: str, key: str) -> Optional[str]:
+    """Return a fresh cached result, or None."""
+    ttl = TOOL_CACHE_TTLS.get(name)
+    if ttl is None:
+        return None
+    try:
+        with _lock:
+            row = _db().execute(
+                "SELECT payload FROM web_cache WHERE key = ? AND fetched_at > ?",
+                (key, time.time() - ttl),
+            ).fetchone()
+    except sqlite3.Error as e:
+        print(f"[ToolCache] lookup skipped: {e}")
+        return None
+    return zlib.decompress(row[0]).decode("utf-8") if row else None
+
+
+def put(name: str, key: str, result: str) -> None:
+    if name not in TOOL_CACHE_TTLS:
+        return
+    now = time.time()
+    payload = zlib.compress(result.encode("utf-8"))
+    try:
+        with _lock:
+            db = _db()
+            db.execute(
+                "INSERT OR REPLACE INTO web_cache (key, tool, fetched_at, payload) VALUES (?, ?, ?, ?)",
+                (key, name, now, payload),
+            )
+            # 一番長い TTL より古いものは必ず期限切れ。件数の上限は古い順に削る。
+            db.execute("DELETE FROM web_cache WHERE fetched_at <= ?", (now - max(TOOL_CACHE_TTLS.values()),))
+            db.execute(
+                "DELETE FROM web_cache WHERE key IN"
+                " (SELECT key FROM web_cache ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                (TOOL_CACHE_MAX_ENTRIES,),
+            )
+    except sqlite3.Error as e:
+        print(f"[ToolCache] store skipped: {e}")
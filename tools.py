@@ -1,12 +1,23 @@
 # Tool Definitions and Executor
+import atexit
+import codecs
+import errno
 import json
+import importlib.util
 import ipaddress
+import os
+import re
+import shutil
 import socket
+import stat
 import subprocess
+import sys
 import threading
 import time
 import sqlite3
 import urllib3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Optional
 from urllib.parse import quote_plus, urlparse
@@ -25,6 +36,8 @@ from config import (
     LOGS_DIR,
     WORKSPACE_DIR,
 )
+import jsonutil
+from keywords import compile_keywords
 
 
 # ============ Path Safety ============
@@ -48,6 +61,8 @@ SAFE_TOOL_DESCRIPTIONS = {
     "list_dir": "list_dir(path) - List files inside the sandboxed workspace.",
     "read_text": "read_text(path) - Read a UTF-8 text file inside the sandboxed workspace.",
     "read_url": "read_url(url) - Read a public web page as text.",
+    "read_urls": "read_urls(urls) - Read several public web pages at once (space-separated URLs, up to 5).",
+    "search_and_read": "search_and_read(query) - Search the public web and read the top 3 result pages.",
     "search_tweets": "search_tweets(query, limit=5) - Search the local tweet memory database.",
     "search_web": "search_web(query) - Search the public web.",
 }
@@ -208,6 +223,49 @@ def validate_public_url(url: str) -> str:
     return url
 
 
+# 検証済み IP ごとの接続プール。同じホストへの2回目以降は TCP/TLS の接続をやり直さずに keep-alive で再利用する。
+# キーに Host/SNI 名も含めるので、証明書検証の対象が別ホストのプールと混ざることはない。
+_POOLS_MAX = 32
+_pools: "OrderedDict[tuple, urllib3.HTTPConnectionPool]" = OrderedDict()
+_pools_lock = threading.Lock()
+_FETCH_RETRIES = urllib3.Retry(
+    total=2,
+    redirect=False,
+    status_forcelist=(502, 503, 504),
+    backoff_factor=0.3,
+    raise_on_status=False,
+)
+
+
+def _get_pinned_pool(scheme: str, ip_text: str, port: int, host: str) -> urllib3.HTTPConnectionPool:
+    key = (scheme, ip_text, port, host)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is not None:
+            _pools.move_to_end(key)
+            return pool
+        # HTTPS の場合は「接続先IP」と「証明書検証用ホスト名」を分ける。
+        if scheme == "https":
+            pool = urllib3.HTTPSConnectionPool(
+                host=ip_text,
+                port=port,
+                assert_hostname=host,
+                server_hostname=host,
+                maxsize=4,
+            )
+        else:
+            pool = urllib3.HTTPConnectionPool(host=ip_text, port=port, maxsize=4)
+        _pools[key] = pool
+        if len(_pools) > _POOLS_MAX:
+            _, old_pool = _pools.popitem(last=False)
+            old_pool.close()
+        return pool
+
+
+# urllib3 が展開できる形式だけを名乗る (brotli / zstandard が入っていれば br / zstd も付く)
+_ACCEPT_ENCODING = urllib3.util.make_headers(accept_encoding=True)["accept-encoding"]
+
+
 def fetch_public_response(url: str) -> tuple[str, urllib3.response.BaseHTTPResponse]:
     """
     検証済みの public URL に対して実際に GET を行う。
@@ -220,25 +278,13 @@ def fetch_public_response(url: str) -> tuple[str, urllib3.response.BaseHTTPRespo
     headers = {
         "Host": resolved["host"],
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Mafuyu/1.0",
+        "Accept-Encoding": _ACCEPT_ENCODING,
     }
 
     last_error: Exception | None = None
     for ip_text in resolved["resolved_ips"]:
         try:
-            # HTTPS の場合は「接続先IP」と「証明書検証用ホスト名」を分ける。
-            if resolved["scheme"] == "https":
-                pool = urllib3.HTTPSConnectionPool(
-                    host=ip_text,
-                    port=resolved["port"],
-                    assert_hostname=resolved["host"],
-                    server_hostname=resolved["host"],
-                )
-            else:
-                pool = urllib3.HTTPConnectionPool(
-                    host=ip_text,
-                    port=resolved["port"],
-                )
-
+            pool = _get_pinned_pool(resolved["scheme"], ip_text, resolved["port"], resolved["host"])
             response = pool.request(
                 "GET",
                 resolved["target"],
@@ -246,13 +292,15 @@ def fetch_public_response(url: str) -> tuple[str, urllib3.response.BaseHTTPRespo
                 redirect=False,
                 preload_content=False,
                 timeout=urllib3.Timeout(connect=10.0, read=30.0),
-                retries=False,
+                retries=_FETCH_RETRIES,
             )
             # redirect を許すと、検証済みの URL から内部URLへ飛ばされる。
             if 300 <= response.status < 400:
                 location = response.headers.get("Location", "")
+                response.close()  # 本文を読まないので keep-alive には戻さない
                 raise ValueError(f"HTTP redirects are not allowed: {location}")
             if response.status >= 400:
+                response.close()
                 raise urllib3.exceptions.HTTPError(f"HTTP {response.status}")
             return resolved["url"], response
         except Exception as exc:
@@ -304,6 +352,20 @@ def _read_limited_response_body(resp: urllib3.response.BaseHTTPResponse, max_byt
     return bytes(body)
 
 
+def _read_response_prefix(resp: urllib3.response.BaseHTTPResponse, max_bytes: int) -> tuple[bytes, bool]:
+    """
+    展開後の本文を max_bytes を超えるまで読む。(本文, 最後まで読めたか) を返す。
+
+    先頭だけ使う呼び出し側向け。上限を超えた時点で受信も展開もやめる。
+    """
+    body = bytearray()
+    for chunk in resp.stream(16 * 1024, decode_content=True):
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            return bytes(body), False
+    return bytes(body), True
+
+
 def _codex_bridge_paths() -> tuple[Path, Path, Path]:
     """Codex bridge 用の入出力ファイルを sandbox 配下にまとめる。"""
     bridge_dir = CODEX_BRIDGE_DIR
@@ -317,49 +379,107 @@ def _codex_bridge_paths() -> tuple[Path, Path, Path]:
 
 # ============ File Tools (Full Access Mode) ============
 
+def _stat_or_none(path: Path) -> Optional[os.stat_result]:
+    """exists() と is_dir()/is_file() を別々に呼ぶ代わりに、stat 1回で存在と種類を見る。"""
+    try:
+        return path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
 def list_dir(path: str = ".") -> dict:
     """List files in any directory."""
     try:
         target = safe_path(path)
-        if not target.exists():
+        st = _stat_or_none(target)
+        if st is None:
             return {"error": f"Directory not found: {path}"}
-        if not target.is_dir():
+        if not stat.S_ISDIR(st.st_mode):
             return {"error": f"Not a directory: {path}"}
         
-        items = []
-        for item in target.iterdir():
-            items.append({
-                "name": item.name,
-                "type": "dir" if item.is_dir() else "file",
-                "size": item.stat().st_size if item.is_file() else None
-            })
-        
+        # DirEntry の is_dir/is_file は readdir の型情報をそのまま使うので、stat はファイルのサイズ用の1回だけ
+        with os.scandir(target) as entries:
+            items = [
+                {
+                    "name": entry.name,
+                    "type": "dir" if entry.is_dir() else "file",
+                    "size": entry.stat().st_size if entry.is_file() else None,
+                }
+                for entry in entries
+            ]
+
         return {"path": str(target), "items": items}
     except Exception as e:
         return {"error": f"list_dir failed: {e}"}
 
 
+# 何度も読まれるファイル (設定やテンプレート) は中身をメモリに持つ。上限は件数ではなくバイト数。
+READ_TEXT_CACHE_BYTES = 64 * 1024 * 1024
+_read_text_cache: "OrderedDict[Path, tuple[int, int, str]]" = OrderedDict()  # path -> (mtime_ns, size, content)
+_read_text_cache_bytes = 0
+_read_text_lock = threading.Lock()
+
+
+def _read_text_cached(target: Path, st: os.stat_result) -> str:
+    """mtime と size が前回と同じならキャッシュを返し、変わっていれば読み直す。"""
+    global _read_text_cache_bytes
+    with _read_text_lock:
+        cached = _read_text_cache.get(target)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            _read_text_cache.move_to_end(target)
+            return cached[2]
+
+    content = target.read_text(encoding="utf-8")
+    with _read_text_lock:
+        old = _read_text_cache.pop(target, None)
+        if old:
+            _read_text_cache_bytes -= old[1]
+        if st.st_size <= READ_TEXT_CACHE_BYTES:
+            _read_text_cache[target] = (st.st_mtime_ns, st.st_size, content)
+            _read_text_cache_bytes += st.st_size
+            while _read_text_cache_bytes > READ_TEXT_CACHE_BYTES:
+                _read_text_cache_bytes -= _read_text_cache.popitem(last=False)[1][1]
+    return content
+
+
+def _forget_read_text(target: Path) -> None:
+    # mtime の粒度が粗いファイルシステムでも、書き込み直後に古い中身を返さないようにする
+    global _read_text_cache_bytes
+    with _read_text_lock:
+        old = _read_text_cache.pop(target, None)
+        if old:
+            _read_text_cache_bytes -= old[1]
+
+
 def read_text(path: str) -> dict:
     """Read text file from any location."""
     try:
         target = safe_path(path)
-        if not target.exists():
+        st = _stat_or_none(target)
+        if st is None:
             return {"error": f"File not found: {path}"}
-        if not target.is_file():
+        if not stat.S_ISREG(st.st_mode):
             return {"error": f"Not a file: {path}"}
-        
-        content = target.read_text(encoding="utf-8")
+
+        content = _read_text_cached(target, st)
         return {"path": str(target), "content": content}
     except Exception as e:
         return {"error": f"read_text failed: {e}"}
 
 
+WRITE_CHUNK_CHARS = 1 << 20
+
+
 def write_text(path: str, content: str) -> dict:
     """Write text file to any location."""
     try:
         target = safe_path(path)
         target.parent.mkdir(parents=True, exist_ok=True)
-        target.write_text(content, encoding="utf-8")
+        _forget_read_text(target)
+        # 一度に encode すると str と同じ大きさの bytes がもう1つできるので、大きい内容は分けて書く
+        with open(target, "w", encoding="utf-8") as f:
+            for start in range(0, len(content), WRITE_CHUNK_CHARS):
+                f.write(content[start:start + WRITE_CHUNK_CHARS])
         return {"path": str(target), "written": len(content), "success": True}
     except Exception as e:
         return {"error": f"write_text failed: {e}"}
@@ -369,9 +489,10 @@ def delete_file(path: str) -> dict:
     """Delete a file."""
     try:
         target = safe_path(path)
-        if not target.exists():
+        st = _stat_or_none(target)
+        if st is None:
             return {"error": f"File not found: {path}"}
-        if target.is_dir():
+        if stat.S_ISDIR(st.st_mode):
             return {"error": f"Use delete_dir for directories: {path}"}
         target.unlink()
         return {"path": str(target), "deleted": True}
@@ -381,12 +502,12 @@ def delete_file(path: str) -> dict:
 
 def delete_dir(path: str) -> dict:
     """Delete a directory and all contents."""
-    import shutil
     try:
         target = safe_path(path)
-        if not target.exists():
+        st = _stat_or_none(target)
+        if st is None:
             return {"error": f"Directory not found: {path}"}
-        if not target.is_dir():
+        if not stat.S_ISDIR(st.st_mode):
             return {"error": f"Not a directory: {path}"}
         shutil.rmtree(target)
         return {"path": str(target), "deleted": True}
@@ -396,14 +517,24 @@ def delete_dir(path: str) -> dict:
 
 def move_file(src: str, dst: str) -> dict:
     """Move/rename a file or directory."""
-    import shutil
     try:
         src_path = safe_path(src)
         dst_path = safe_path(dst)
-        if not src_path.exists():
+        if _stat_or_none(src_path) is None:
             return {"error": f"Source not found: {src}"}
         dst_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.move(str(src_path), str(dst_path))
+        dst_st = _stat_or_none(dst_path)
+        if dst_st is not None and stat.S_ISDIR(dst_st.st_mode):
+            # 既存ディレクトリの中へ移す、という shutil.move の意味を保つ
+            shutil.move(str(src_path), str(dst_path))
+        else:
+            # 同じファイルシステム内なら rename 1回で済む。別デバイスのときだけコピー + 削除
+            try:
+                os.replace(src_path, dst_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(str(src_path), str(dst_path))
         return {"src": str(src_path), "dst": str(dst_path), "moved": True}
     except Exception as e:
         return {"error": f"move_file failed: {e}"}
@@ -411,16 +542,17 @@ def move_file(src: str, dst: str) -> dict:
 
 def copy_file(src: str, dst: str) -> dict:
     """Copy a file."""
-    import shutil
     try:
         src_path = safe_path(src)
         dst_path = safe_path(dst)
-        if not src_path.exists():
+        src_st = _stat_or_none(src_path)
+        if src_st is None:
             return {"error": f"Source not found: {src}"}
         dst_path.parent.mkdir(parents=True, exist_ok=True)
-        if src_path.is_dir():
+        if stat.S_ISDIR(src_st.st_mode):
             shutil.copytree(str(src_path), str(dst_path))
         else:
+            # copy2 は Linux では sendfile、macOS では fcopyfile でカーネル内コピーになる (Python 3.8+)。Windows の CopyFile2 は 3.12+
             shutil.copy2(str(src_path), str(dst_path))
         return {"src": str(src_path), "dst": str(dst_path), "copied": True}
     except Exception as e:
@@ -433,13 +565,20 @@ def fetch_url(url: str) -> dict:
     """公開URLの本文を文字列として取得する。"""
     try:
         validated_url, resp = fetch_public_response(url)
+        # UTF-8 は1文字最大4バイトなので、FETCH_MAX_CHARS 文字分にはその4倍読めば足りる
+        complete = False
         try:
-            text_full = _read_limited_response_body(resp, FETCH_MAX_TEXT_BYTES).decode("utf-8", errors="replace")
+            body, complete = _read_response_prefix(resp, min(FETCH_MAX_TEXT_BYTES, FETCH_MAX_CHARS * 4))
         finally:
-            resp.release_conn()
+            if complete:
+                resp.release_conn()
+            else:
+                resp.close()  # 読み残しがある接続は pool に戻さない
 
+        # 途中で切った場合、末尾の欠けたマルチバイト文字は置換文字にせず捨てる
+        text_full = codecs.getincrementaldecoder("utf-8")(errors="replace").decode(body, final=complete)
         text = text_full[:FETCH_MAX_CHARS]
-        truncated = len(text_full) > FETCH_MAX_CHARS
+        truncated = not complete or len(text_full) > FETCH_MAX_CHARS
         
         return {
             "url": validated_url,
@@ -471,6 +610,10 @@ def fetch_json(url: str) -> dict:
         return {"error": f"fetch_json failed: {e}"}
 
 
+# read_url が返す本文の上限。要約は呼ばない (下の docstring 参照) ので、超えた分は切るだけ。
+READ_URL_MAX_CHARS = 3000
+
+
 def read_url(url: str) -> dict:
     """
     Web ページを取得し、人が読みやすい本文テキストへ整形する。
@@ -479,51 +622,29 @@ def read_url(url: str) -> dict:
     面が増えるため、ここでは BeautifulSoup で機械的に整形するだけにしている。
     """
     try:
-        from bs4 import BeautifulSoup
-
         validated_url, resp = fetch_public_response(url)
         try:
             html = _read_limited_response_body(resp, FETCH_MAX_HTML_BYTES).decode("utf-8", errors="replace")
         finally:
             resp.release_conn()
-        soup = BeautifulSoup(html, "html.parser")
-        
-        # スクリプトやレイアウト要素は本文抽出のノイズになるので落とす。
-        for script in soup(["script", "style", "nav", "footer", "header"]):
-            script.decompose()
-            
-        # ページ全体からテキストだけを抜き出す。
-        text = soup.get_text(separator="\n")
-        
+
+        # スクリプトやレイアウト要素を落として、ページ全体からテキストだけを抜き出す。
+        title, text = None, ""
+        if HTML_PARSER == "lxml":
+            try:
+                title, text = _extract_page_lxml(html)
+            except ValueError:  # 空の文書や encoding 宣言付きの XML など
+                title = None
+        if title is None:
+            title, text = _extract_page_bs4(html)
+
         # 改行や余白を整えて、読みやすいプレーンテキストに寄せる。
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = '\n'.join(chunk for chunk in chunks if chunk)
-        
-        title = soup.title.string if soup.title else ""
+        text = _clean_page_text(text)
+
         # 長すぎるページは deterministic に打ち切る。
-        if len(text) > 3000:
-            text = text[:3000] + "...(truncated)"
-        
-        # Auto-summarize if content is too long (> 3000 chars)
-        if False and len(text) > 3000:
-            try:
-                from llm import call_ollama
-                summary_prompt = f"""以下のWebページの内容を、重要なポイントを抽出して300字以内で要約せよ。
-事実のみ、簡潔に。
-
----
-{text[:6000]}
----
-
-要約:"""
-                messages = [{"role": "user", "content": summary_prompt}]
-                summary = call_ollama(messages)
-                text = f"[要約]\n{summary}\n\n[元の文字数: {len(text)}文字]"
-            except Exception as e:
-                # Fallback: just truncate
-                text = text[:3000] + "...(truncated)"
-            
+        if len(text) > READ_URL_MAX_CHARS:
+            text = text[:READ_URL_MAX_CHARS] + "...(truncated)"
+
         return {
             "url": validated_url,
             "title": title,
@@ -535,6 +656,86 @@ def read_url(url: str) -> dict:
         return {"error": f"read_url failed: {e}"}
 
 
+# lxml (C 実装) があればそちらで parse する。無ければ標準の html.parser。
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+# 本文抽出のノイズになるので落とすタグ
+_DROP_TAGS = ("script", "style", "nav", "footer", "header")
+# str.splitlines() と同じ改行文字、または2つ以上続く空白の区切り ("  ")
+_TEXT_SPLIT_RE = re.compile(r"\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]|  ")
+
+
+def _extract_page_lxml(html: str) -> tuple[str, str]:
+    """(title, text) using lxml directly; removal happens in C instead of a decompose() loop."""
+    from lxml import etree, html as lxml_html
+
+    try:
+        tree = lxml_html.document_fromstring(html)
+    except etree.ParserError as e:
+        raise ValueError(str(e)) from e
+    # with_tail=False は後ろのテキストを前の文字列に連結するので、BeautifulSoup の
+    # get_text(separator="\n") と同じく別の行になるよう改行を挟んでおく
+    for element in tree.iter(*_DROP_TAGS):
+        if element.tail:
+            element.tail = "\n" + element.tail
+    etree.strip_elements(tree, *_DROP_TAGS, with_tail=False)
+    return tree.findtext(".//title") or "", "\n".join(tree.itertext())
+
+
+def _extract_page_bs4(html: str) -> tuple[str, str]:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, HTML_PARSER)
+    for element in soup(_DROP_TAGS):
+        element.decompose()
+    title = soup.title.string if soup.title else ""
+    return title, soup.get_text(separator="\n")
+
+
+def _clean_page_text(text: str) -> str:
+    """Strip each line/phrase of page text and drop the empty ones (one split instead of two passes)."""
+    return "\n".join(filter(None, map(str.strip, _TEXT_SPLIT_RE.split(text))))
+
+
+READ_URLS_MAX = 5
+READ_URLS_MAX_WORKERS = 5
+# CDN/検索結果ページからの 429 を避けるため、同じホストへの同時接続はこの数まで
+READ_URLS_PER_HOST = 4
+READ_URLS_MAX_CHARS = READ_URL_MAX_CHARS
+
+
+def read_urls(urls: list[str] | str) -> dict:
+    """
+    複数の Web ページを並列に取得して read_url と同じ形式で返す。
+
+    取得も BeautifulSoup の整形もスレッドで並列に行う (どちらも I/O 待ちの方が長い)。
+    合計の本文が read_url 1件分に収まるよう、1ページあたりの文字数を件数で割る。
+    """
+    if isinstance(urls, str):
+        urls = urls.replace(",", " ").split()
+    urls = list(dict.fromkeys(urls))[:READ_URLS_MAX]
+    if not urls:
+        return {"error": "No URLs given"}
+
+    host_slots = {urlparse(url).hostname: threading.Semaphore(READ_URLS_PER_HOST) for url in urls}
+    per_page_chars = READ_URLS_MAX_CHARS // len(urls)
+
+    def read_one(url: str) -> dict:
+        with host_slots[urlparse(url).hostname]:
+            page = read_url(url)
+        if "content" in page and len(page["content"]) > per_page_chars:
+            page["content"] = page["content"][:per_page_chars] + "...(truncated)"
+        return page if "error" not in page else {"url": url, **page}
+
+    with ThreadPoolExecutor(max_workers=min(READ_URLS_MAX_WORKERS, len(urls))) as pool:
+        return {"results": list(pool.map(read_one, urls))}
+
+
+# 時事的なクエリには現在の年月を足す。小文字化したクエリに対して1回のスキャンで判定する。
+TIME_KEYWORDS = ['現在', '今', '最新', '今日', '首相', '大統領', '総裁',
+                 'current', 'now', 'latest', 'president', 'prime minister']
+TIME_KEYWORDS_RE = compile_keywords(TIME_KEYWORDS)
+
+
 def search_web(query: str) -> dict:
     """
     Search the web using duckduckgo-search library.
@@ -558,10 +759,7 @@ def search_web(query: str) -> dict:
         
         # Temporal Awareness: Add current date to time-sensitive queries
         from datetime import datetime
-        time_keywords = ['現在', '今', '最新', '今日', '首相', '大統領', '総裁', 
-                         'current', 'now', 'latest', 'president', 'prime minister']
-        query_lower = query.lower()
-        if any(kw in query_lower or kw in query for kw in time_keywords):
+        if TIME_KEYWORDS_RE.search(query.lower()):
             current_date = datetime.now().strftime("%Y年%m月")
             if current_date not in query:
                 query = f"{query} {current_date}"
@@ -589,31 +787,147 @@ def search_web(query: str) -> dict:
         return {"error": f"search_web failed: {e}"}
 
 
+SEARCH_AND_READ_TOP_K = 3
+
+
+def search_and_read(query: str, top_k: int = SEARCH_AND_READ_TOP_K) -> dict:
+    """
+    search_web の上位 top_k 件を read_urls でまとめて読み、結果ごとに本文を付けて返す。
+
+    検索 → read_url を1件ずつ呼ぶとエージェントのターンが件数分増えるので、1回の呼び出しにまとめる。
+    ページの取得と整形は read_urls と同じくスレッドで並列に行う。
+    """
+    found = search_web(query)
+    if "error" in found:
+        return found
+    results = found["results"]
+
+    urls = list(dict.fromkeys(r["url"] for r in results if r["url"]))[:max(1, min(int(top_k), READ_URLS_MAX))]
+    pages = dict(zip(urls, read_urls(urls)["results"])) if urls else {}
+    for r in results:
+        page = pages.get(r["url"])
+        if page is not None:
+            r["content"] = page.get("content", f"(error: {page.get('error')})")
+    return {
+        "query": found["query"],
+        "results": [r for r in results if "content" in r],
+    }
+
+
+TWEETS_DB = DATA_DIR / "memory.db"
+# memory.db は外部の ingestion スクリプトの持ち物なので書き込まない。全文検索の索引は別の DB に読む側だけで持つ。
+TWEETS_INDEX_DB = DATA_DIR / "tweets_index.db"
+# tweets の件数と最大 rowid を見直す間隔 (変わっていたら索引を作り直す)
+TWEETS_INDEX_CHECK_INTERVAL = 60.0
+# trigram は3文字未満を索引できないので、それより短いクエリは従来の LIKE で探す
+TWEETS_FTS_MIN_QUERY = 3
+_tweets_conn: Optional[sqlite3.Connection] = None
+_tweets_index: Optional[sqlite3.Connection] = None
+_tweets_index_disabled = False  # trigram が無い / 索引 DB が使えない
+_tweets_index_checked = 0.0
+_tweets_lock = threading.Lock()
+
+_TWEETS_INDEX_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts5(
+    text, date UNINDEXED, likes UNINDEXED, retweets UNINDEXED, tokenize='trigram'
+);
+CREATE TABLE IF NOT EXISTS tweets_index_meta (row_count INTEGER NOT NULL, max_rowid INTEGER NOT NULL);
+"""
+
+
+def _tweets_db() -> sqlite3.Connection:
+    """読み取り専用の接続を1本だけ開いて使い回す (mmap と大きめの page cache で読む)。"""
+    global _tweets_conn
+    if _tweets_conn is None:
+        conn = sqlite3.connect(f"{TWEETS_DB.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _tweets_conn = conn
+    return _tweets_conn
+
+
+def _tweets_index_db(source: sqlite3.Connection) -> Optional[sqlite3.Connection]:
+    """
+    tweets の写しを持つ trigram FTS5 索引を返す。使えなければ None (呼び出し側は LIKE で探す)。
+
+    tweets の件数か最大 rowid が前回の作成時と変わっていたら、丸ごと作り直す。
+    """
+    global _tweets_index, _tweets_index_disabled, _tweets_index_checked
+    if _tweets_index_disabled or sqlite3.sqlite_version_info < (3, 34, 0):
+        return None
+    try:
+        if _tweets_index is None:
+            _tweets_index = sqlite3.connect(TWEETS_INDEX_DB, check_same_thread=False)
+            _tweets_index.executescript(_TWEETS_INDEX_SCHEMA)
+            _tweets_index_checked = 0.0
+
+        now = time.monotonic()
+        if now - _tweets_index_checked >= TWEETS_INDEX_CHECK_INTERVAL:
+            _tweets_index_checked = now
+            stamp = source.execute("SELECT count(*), coalesce(max(rowid), 0) FROM tweets").fetchone()
+            if _tweets_index.execute("SELECT row_count, max_rowid FROM tweets_index_meta").fetchone() != stamp:
+                rows = source.execute("SELECT text, date, likes, retweets FROM tweets")
+                with _tweets_index:
+                    _tweets_index.execute("DELETE FROM tweets_fts")
+                    _tweets_index.executemany(
+                        "INSERT INTO tweets_fts (text, date, likes, retweets) VALUES (?, ?, ?, ?)", rows
+                    )
+                    _tweets_index.execute("DELETE FROM tweets_index_meta")
+                    _tweets_index.execute("INSERT INTO tweets_index_meta VALUES (?, ?)", stamp)
+        return _tweets_index
+    except sqlite3.Error as e:
+        print(f"[Tweets] full-text index unavailable, using LIKE: {e}")
+        _tweets_index_disabled = True
+        if _tweets_index is not None:
+            _tweets_index.close()
+            _tweets_index = None
+        return None
+
+
+def _reset_tweets_db() -> None:
+    # DB が作り直された場合に備えて、エラー後は次の呼び出しで開き直す
+    global _tweets_conn, _tweets_index_checked
+    if _tweets_conn is not None:
+        _tweets_conn.close()
+        _tweets_conn = None
+    _tweets_index_checked = 0.0
+
+
 def search_tweets(query: str, limit: int = 5) -> dict:
     """
     Search past tweets in the local database.
     RAG (Retrieval-Augmented Generation) function.
     """
     try:
-        db_path = DATA_DIR / "memory.db"
-        if not db_path.exists():
+        if not TWEETS_DB.exists():
             return {"error": "Tweet database not found. Has ingestion been run?"}
 
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Simple LIKE search
-        sql = "SELECT date, text, likes, retweets FROM tweets WHERE text LIKE ? ORDER BY date DESC LIMIT ?"
-        cursor.execute(sql, (f"%{query}%", limit))
-        rows = cursor.fetchall()
-        
+        with _tweets_lock:
+            try:
+                conn = _tweets_db()
+                index = _tweets_index_db(conn) if len(query) >= TWEETS_FTS_MIN_QUERY else None
+                if index is not None:
+                    # trigram のフレーズ検索は LIKE '%query%' と同じ部分一致を索引で引く
+                    rows = index.execute(
+                        "SELECT date, text, likes, retweets FROM tweets_fts"
+                        " WHERE tweets_fts MATCH ? ORDER BY date DESC LIMIT ?",
+                        ('"' + query.replace('"', '""') + '"', limit),
+                    ).fetchall()
+                else:
+                    rows = conn.execute(
+                        "SELECT date, text, likes, retweets FROM tweets WHERE text LIKE ? ORDER BY date DESC LIMIT ?",
+                        (f"%{query}%", limit),
+                    ).fetchall()
+            except sqlite3.Error:
+                _reset_tweets_db()
+                raise
+
         results = []
         for row in rows:
             date, text, likes, retweets = row
             results.append(f"[{date}] {text} (Fav:{likes})")
         
-        conn.close()
-        
         if not results:
             return {"results": [], "summary": f"No tweets found for '{query}'"}
             
@@ -631,6 +945,8 @@ def search_tweets(query: str, limit: int = 5) -> dict:
 
 # Global job registry
 _codex_jobs: dict[str, dict] = {}
+# PATH 上の codex (Windows では codex.cmd など PATHEXT 付き) を起動時に1回だけ解決しておく
+CODEX_EXECUTABLE = shutil.which(CODEX_CMD) or CODEX_CMD
 
 
 def codex_job_start(prompt: str, workdir: str = ".") -> dict:
@@ -655,24 +971,23 @@ def codex_job_start(prompt: str, workdir: str = ".") -> dict:
     try:
         safe_workdir = safe_path(workdir)
         # Build command with non-interactive mode
-        cmd = [CODEX_CMD, "-a", "never", prompt]
-        
-        # Open log file
-        log_file = open(log_path, "w", encoding="utf-8")
+        cmd = [CODEX_EXECUTABLE, "-a", "never", prompt]
         
-        # Start process
-        process = subprocess.Popen(
-            cmd,
-            cwd=str(safe_workdir),
-            stdout=log_file,
-            stderr=subprocess.STDOUT,
-            shell=False,
-            text=True,
-        )
+        # 子プロセスは自分のハンドルを継承して直接書くので、親側のハンドルは起動後すぐ閉じる
+        # (ジョブごとに FD を持ち続けない。失敗したジョブでも with で閉じられる)
+        with open(log_path, "wb") as log_file:
+            process = subprocess.Popen(
+                cmd,
+                cwd=str(safe_workdir),
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                shell=False,
+                # ログはファイルに流すので、Windows でコンソール窓を作らない
+                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+            )
         
         _codex_jobs[job_id] = {
             "process": process,
-            "log_file": log_file,
             "log_path": str(log_path),
             "prompt": prompt,
             "workdir": str(safe_workdir),
@@ -687,6 +1002,22 @@ def codex_job_start(prompt: str, workdir: str = ".") -> dict:
         return {"error": f"codex_job_start failed: {e}"}
 
 
+def _tail_lines(path: Path, n: int, block_size: int = 64 * 1024) -> list[str]:
+    """ファイル末尾の n 行を返す。ログ全体は読まず、末尾のブロックを必要なだけ広げて読む。"""
+    if n <= 0:
+        return []
+    with path.open("rb") as f:
+        size = f.seek(0, 2)
+        while True:
+            start = max(0, size - block_size)
+            f.seek(start)
+            lines = f.read(size - start).decode("utf-8", errors="replace").splitlines()
+            # 途中から読んだ場合、先頭の行は欠けているかもしれないので n 行より多く取れるまで広げる
+            if start == 0 or len(lines) > n:
+                return lines[-n:]
+            block_size *= 2
+
+
 def codex_job_status(job_id: str) -> dict:
     """Get status and last N lines of Codex job."""
     if not ENABLE_CODEX_TOOLS:
@@ -712,8 +1043,7 @@ def codex_job_status(job_id: str) -> dict:
     last_lines = []
     if log_path.exists():
         try:
-            lines = log_path.read_text(encoding="utf-8").splitlines()
-            last_lines = lines[-CODEX_LOG_TAIL_LINES:]
+            last_lines = _tail_lines(log_path, CODEX_LOG_TAIL_LINES)
         except Exception:
             pass
     
@@ -746,18 +1076,24 @@ def codex_job_stop(job_id: str) -> dict:
     except subprocess.TimeoutExpired:
         process.kill()
     
-    # Close log file
-    try:
-        job["log_file"].close()
-    except Exception:
-        pass
-    
     return {
         "job_id": job_id,
         "stopped": True
     }
 
 
+@atexit.register
+def _cleanup_codex_jobs() -> None:
+    """終了時にまだ動いている Codex ジョブを止める。"""
+    for job in _codex_jobs.values():
+        process = job["process"]
+        if process.poll() is None:
+            process.terminate()
+
+
+
+PYTHON_TOOL_TIMEOUT = 30
+
 
 def run_python_code(code: str) -> dict:
     """
@@ -776,10 +1112,10 @@ def run_python_code(code: str) -> dict:
         print(f"[Python] Executing code:\n{code[:80]}...")
         
         result = subprocess.run(
-            ["python", "-c", code],
+            [sys.executable, "-c", code],
             capture_output=True,
             text=True,
-            timeout=30 # Safety timeout
+            timeout=PYTHON_TOOL_TIMEOUT # Safety timeout
         )
         
         output = result.stdout
@@ -799,6 +1135,9 @@ def run_python_code(code: str) -> dict:
 
 
 
+CODEX_BRIDGE_PICKUP_TIMEOUT = 1.0
+
+
 def codex_run_captured(prompt: str, workdir: str = ".") -> dict:
     """
     Start a new task on the Codex Bridge (Interactive Mode).
@@ -817,11 +1156,16 @@ def codex_run_captured(prompt: str, workdir: str = ".") -> dict:
     req_data = {"prompt": prompt}
     
     try:
-        with request_file.open("w", encoding="utf-8") as f:
+        # Bridge が書きかけのファイルを読まないよう、tmp に書いてから置き換える
+        tmp_file = request_file.with_suffix(".json.tmp")
+        with tmp_file.open("w", encoding="utf-8") as f:
             json.dump(req_data, f, ensure_ascii=False, indent=2)
-        
-        # We wait a brief moment to let Bridge pick it up?
-        time.sleep(1)
+        os.replace(tmp_file, request_file)
+
+        # Bridge は request.json を読んだら消すので、消えた時点で返す (1秒待っても残っていればそのまま返す)
+        deadline = time.monotonic() + CODEX_BRIDGE_PICKUP_TIMEOUT
+        while request_file.exists() and time.monotonic() < deadline:
+            time.sleep(0.02)
         return {"success": True, "output": "Task sent to Bridge. Check output with 'codex_read_output'.", "exit_code": 0}
         
     except Exception as e:
@@ -844,10 +1188,7 @@ def codex_read_output(lines: int = 20) -> dict:
         return {"success": True, "output": "(No output log found yet)", "exit_code": 0}
         
     try:
-        with output_file.open("r", encoding="utf-8", errors="replace") as f:
-            content = f.read().splitlines()
-
-        tail = "\n".join(content[-max(1, lines):])
+        tail = "\n".join(_tail_lines(output_file, max(1, lines)))
         return {"success": True, "output": tail, "exit_code": 0}
     except Exception as e:
         return {"success": False, "output": f"Error reading log: {e}", "exit_code": -1}
@@ -903,7 +1244,7 @@ def codex_run_sync(prompt: str, workdir: str = ".") -> dict:
 
         # 引数を PowerShell の文字列連結に直接入れないため、Base64 で渡す。
         prompt_b64 = base64.b64encode(prompt.encode("utf-8")).decode("ascii")
-        codex_cmd_literal = CODEX_CMD.replace("'", "''")
+        codex_cmd_literal = CODEX_EXECUTABLE.replace("'", "''")
         ps_script = (
             "$prompt = [System.Text.Encoding]::UTF8.GetString("
             f"[System.Convert]::FromBase64String('{prompt_b64}')); "
@@ -943,7 +1284,9 @@ SAFE_TOOLS = {
     "fetch_url": fetch_url,
     "fetch_json": fetch_json,
     "read_url": read_url,
+    "read_urls": read_urls,
     "search_web": search_web,
+    "search_and_read": search_and_read,
     "search_tweets": search_tweets,
 }
 
@@ -967,14 +1310,43 @@ ALL_TOOLS = {**SAFE_TOOLS, **PRIVILEGED_TOOLS}
 TOOLS = SAFE_TOOLS
 
 
+# orjson が無いときの fallback 用 (上限を超えた時点で encode を止める)
+_TOOL_RESULT_ENCODER = json.JSONEncoder(ensure_ascii=False, indent=2)
+
+
+def _dump_tool_result(result, max_chars: Optional[int] = None) -> str:
+    """
+    2スペース字下げの JSON にする。max_chars を超える分は "...(truncated)" に置き換える。
+
+    {"error": ...} は呼び出し側が JSON として読めるように切らない (どれも短い)。
+    """
+    if max_chars is None or (isinstance(result, dict) and "error" in result):
+        return jsonutil.dumps(result, indent=True).decode("utf-8")
+    if jsonutil.orjson is not None:
+        # C 実装なので全体を encode してから切っても、途中で止める Python 実装より速い
+        text = jsonutil.dumps(result, indent=True).decode("utf-8")
+    else:
+        parts, size = [], 0
+        for chunk in _TOOL_RESULT_ENCODER.iterencode(result):
+            parts.append(chunk)
+            size += len(chunk)
+            if size > max_chars:
+                break
+        text = "".join(parts)
+    if len(text) > max_chars:
+        text = text[:max_chars] + "...(truncated)"
+    return text
+
+
 def execute_tool(
     tool_name: str,
     args: dict,
     allow_privileged: bool = False,
     allowed_tool_names: Optional[set[str]] = None,
+    max_chars: Optional[int] = None,
 ) -> str:
     """
-    ツールを実行し、その結果を JSON 文字列で返す。
+    ツールを実行し、その結果を JSON 文字列で返す (max_chars を超える結果は切り詰める)。
 
     通常のチャット経路では safe tools だけを公開し、privileged tools は
     明示的に許可された経路でしか使えないようにしている。
@@ -982,16 +1354,16 @@ def execute_tool(
     effective_allowed_tool_names = set(allowed_tool_names or SAFE_TOOL_NAMES)
 
     if tool_name not in effective_allowed_tool_names:
-        return json.dumps({"error": f"Tool not allowed in this context: {tool_name}"})
+        return _dump_tool_result({"error": f"Tool not allowed in this context: {tool_name}"})
 
     registry = ALL_TOOLS
     if tool_name not in registry:
-        return json.dumps({"error": f"Unknown tool: {tool_name}"})
+        return _dump_tool_result({"error": f"Unknown tool: {tool_name}"})
     
     try:
         result = registry[tool_name](**args)
-        return json.dumps(result, ensure_ascii=False, indent=2)
+        return _dump_tool_result(result, max_chars)
     except TypeError as e:
-        return json.dumps({"error": f"Invalid arguments for {tool_name}: {e}"})
+        return _dump_tool_result({"error": f"Invalid arguments for {tool_name}: {e}"})
     except Exception as e:
-        return json.dumps({"error": f"Tool execution failed: {e}"})
+        return _dump_tool_result({"error": f"Tool execution failed: {e}"})